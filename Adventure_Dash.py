@@ -1,12 +1,37 @@
 import pygame
+import os
 import sys
 import random
 import math
+import pickle
+import zlib
+import time
+import struct
+import queue
+import asyncio
+import threading
+import argparse
+import sqlite3
+import tracemalloc
+import multiprocessing
+from concurrent.futures import Future
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# Replay rendering and the allocation check draw off-screen, so pick SDL's
+# dummy drivers before it starts and no window is ever opened. Spawned render
+# workers inherit the environment.
+if {arg.partition("=")[0] for arg in sys.argv[1:]} & {"--render", "--alloc-check"}:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
 
 pygame.init()
 
 # --- Window (resizable) ---
 WIDTH, HEIGHT = 800, 600
+FPS = 60
 screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
 pygame.display.set_caption("Hero Adventure - University Project")
 
@@ -48,28 +73,235 @@ except Exception:
     jump_sound = None
     door_sound = None
 
+# Resimulation (netplay rollback, ghosts) must not replay sounds or effects
+effects_enabled = True
 
-# --- Button Class ---
-class Button:
+
+@contextmanager
+def quiet():
+    global effects_enabled
+    previous = effects_enabled
+    effects_enabled = False
+    try:
+        yield
+    finally:
+        effects_enabled = previous
+
+
+# While set, sounds and particle bursts are queued here instead of run; the
+# simulation thread uses it so the mixer and particle arrays stay on the main thread
+deferred_effects = None
+
+
+@contextmanager
+def deferred(sink):
+    global deferred_effects
+    deferred_effects = sink
+    try:
+        yield
+    finally:
+        deferred_effects = None
+
+
+def play_sound(sound):
+    if sound and effects_enabled:
+        if deferred_effects is not None:
+            deferred_effects.put((sound.play, ()))
+        else:
+            sound.play()
+
+
+def stop_sound(sound):
+    if sound:
+        if deferred_effects is not None:
+            deferred_effects.put((sound.stop, ()))
+        else:
+            sound.stop()
+
+
+# --- UI Widgets ---
+# Retained widgets: each one renders its surface once and keeps it until its
+# content changes, so a frame of a menu is a handful of blits.
+class Widget:
+    def __init__(self, rect):
+        self.rect = pygame.Rect(rect)
+        self.surface = None
+        self.next_frame = None  # get_ticks() time an animated widget next needs drawing
+
+    def render(self):
+        raise NotImplementedError
+
+    def invalidate(self):
+        self.surface = None
+
+    def draw(self, surface):
+        if self.surface is None:
+            self.surface = self.render()
+        surface.blit(self.surface, self.rect)
+
+    def hover(self, pos):
+        # Returns True when the hover state changed
+        return False
+
+    def clicked(self, pos):
+        return False
+
+
+class Label(Widget):
+    def __init__(self, text, pos, text_font=None, color=WHITE, anchor="topleft"):
+        super().__init__((pos, (0, 0)))
+        self.text = text
+        self.pos = pos
+        self.font = text_font or font
+        self.color = color
+        self.anchor = anchor
+
+    def set_text(self, text):
+        if text != self.text:
+            self.text = text
+            self.invalidate()
+
+    def render(self):
+        surface = self.font.render(self.text, True, self.color)
+        self.rect = surface.get_rect(**{self.anchor: self.pos})
+        return surface
+
+
+class GlowLabel(Label):
+    # Label with darker copies stacked behind it, offset down and right
+    def __init__(self, text, pos, text_font, color, glow_steps=3):
+        super().__init__(text, pos, text_font, color, anchor="midtop")
+        self.glow_steps = glow_steps
+
+    def render(self):
+        main = self.font.render(self.text, True, self.color)
+        n = self.glow_steps
+        surface = pygame.Surface((main.get_width() + n, main.get_height() + n), pygame.SRCALPHA)
+        for offset in range(n, 0, -1):
+            r, g, b = self.color
+            surface.blit(self.font.render(self.text, True, (r // offset, g // offset, b // offset)), (offset, offset))
+        surface.blit(main, (0, 0))
+        self.rect = main.get_rect(midtop=self.pos)
+        self.rect.size = surface.get_size()
+        return surface
+
+
+class Panel(Widget):
+    def __init__(self, rect, color, border_color, border=3, radius=10):
+        super().__init__(rect)
+        self.color = color
+        self.border_color = border_color
+        self.border = border
+        self.radius = radius
+
+    def render(self):
+        surface = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+        local = surface.get_rect()
+        pygame.draw.rect(surface, self.color, local, border_radius=self.radius)
+        pygame.draw.rect(surface, self.border_color, local, self.border, border_radius=self.radius)
+        return surface
+
+
+class Button(Widget):
     def __init__(self, text, rect, color, hover_color, action):
+        super().__init__(rect)
         self.text = text
-        self.rect = pygame.Rect(rect)
         self.color = color
         self.hover_color = hover_color
         self.action = action
-
-    def draw(self):
-        mx, my = pygame.mouse.get_pos()
-        hovered = self.rect.collidepoint((mx, my))
-        pygame.draw.rect(screen, self.hover_color if hovered else self.color, self.rect, border_radius=8)
-        pygame.draw.rect(screen, BLACK, self.rect, 2, border_radius=8)
+        self.hovered = False
+        self.surfaces = None
+
+    def render_state(self, color):
+        surface = pygame.Surface(self.rect.size, pygame.SRCALPHA)
+        local = surface.get_rect()
+        pygame.draw.rect(surface, color, local, border_radius=8)
+        pygame.draw.rect(surface, BLACK, local, 2, border_radius=8)
         txt = font.render(self.text, True, WHITE)
-        screen.blit(txt, (self.rect.centerx - txt.get_width() // 2, self.rect.centery - txt.get_height() // 2))
+        surface.blit(txt, (local.centerx - txt.get_width() // 2, local.centery - txt.get_height() // 2))
+        return surface
+
+    def render(self):
+        if self.surfaces is None:
+            self.surfaces = (self.render_state(self.color), self.render_state(self.hover_color))
+        return self.surfaces[self.hovered]
+
+    def hover(self, pos):
+        hovered = self.rect.collidepoint(pos)
+        if hovered != self.hovered:
+            self.hovered = hovered
+            self.invalidate()
+            return True
+        return False
 
     def clicked(self, pos):
         return self.rect.collidepoint(pos)
 
 
+class LiveWidget(Widget):
+    # Escape hatch for animated parts of a screen; asks for a redraw every interval ms.
+    # One that animates an optional quality effect stops asking while it is off.
+    def __init__(self, draw_fn, interval=1000 // FPS, effect=None):
+        super().__init__((0, 0, 0, 0))
+        self.draw_fn = draw_fn
+        self.interval = interval
+        self.effect = effect
+        self.next_frame = 0
+
+    def draw(self, surface):
+        if self.effect and not quality.on(self.effect):
+            self.next_frame = None
+            return
+        self.draw_fn()
+        self.next_frame = pygame.time.get_ticks() + self.interval
+
+
+class TickClock:
+    # Whole 1/FPS ticks of wall time since the last call. Idle screens wake
+    # irregularly, so their effects advance by this rather than once per draw.
+    def __init__(self, limit=FPS):
+        self.limit = limit  # after a long stall, skip ahead instead of replaying it
+        self.last = pygame.time.get_ticks() * FPS // 1000
+
+    def elapsed(self):
+        now = pygame.time.get_ticks() * FPS // 1000
+        ticks = min(now - self.last, self.limit)
+        self.last = now
+        return ticks
+
+
+class UIScreen:
+    def __init__(self, widgets, fill=None, **named):
+        self.widgets = widgets
+        self.fill = fill
+        self.named = named
+        self.dirty = True  # set when something retained changed since the last draw
+
+    def update(self, mouse_pos):
+        for widget in self.widgets:
+            if widget.hover(mouse_pos):
+                self.dirty = True
+
+    def draw(self, surface):
+        if self.fill:
+            surface.fill(self.fill)
+        for widget in self.widgets:
+            widget.draw(surface)
+        self.dirty = False
+
+    def wait_time(self, now):
+        # ms until an animated widget is due again; None when nothing animates
+        due = [widget.next_frame for widget in self.widgets if widget.next_frame is not None]
+        return max(0, min(due) - now) if due else None
+
+    def click(self, pos):
+        for widget in self.widgets:
+            if widget.clicked(pos):
+                widget.action()
+                return True
+        return False
+
+
 # --- Platform Class ---
 class Platform:
     def __init__(self, x, y, width, height=20, is_ground=False):
@@ -78,37 +310,74 @@ class Platform:
         self.width = width
         self.height = height
         self.is_ground = is_ground
-        self.rect = pygame.Rect(x, y, width, height)
+        self.update_rect()
         
     def draw(self):
         if self.is_ground:
             # Draw ground platform
-            pygame.draw.rect(screen, BROWN, (self.x, self.y, self.width, self.height))
+            pygame.draw.rect(screen, BROWN, self.rect)
             # Grass on top
-            pygame.draw.rect(screen, GRASS_GREEN, (self.x, self.y, self.width, 8))
+            pygame.draw.rect(screen, GRASS_GREEN, self.grass_rect)
             # Ground details
-            for i in range(0, self.width, 20):
-                pygame.draw.line(screen, PLATFORM_DARK, (self.x + i, self.y + 8), 
-                               (self.x + i, self.y + self.height), 1)
+            for start, end in self.detail_lines:
+                pygame.draw.line(screen, PLATFORM_DARK, start, end, 1)
         else:
             # Draw floating platform
             # Platform shadow
-            pygame.draw.rect(screen, PLATFORM_DARK, (self.x + 3, self.y + 3, self.width, self.height))
+            pygame.draw.rect(screen, PLATFORM_DARK, self.shadow_rect)
             # Platform body
-            pygame.draw.rect(screen, PLATFORM_BROWN, (self.x, self.y, self.width, self.height), border_radius=4)
+            pygame.draw.rect(screen, PLATFORM_BROWN, self.rect, border_radius=quality.radius(4))
             # Grass on top
-            pygame.draw.rect(screen, GRASS_GREEN, (self.x, self.y, self.width, 6), border_radius=4)
+            pygame.draw.rect(screen, GRASS_GREEN, self.grass_rect, border_radius=quality.radius(4))
             # Platform sides
-            pygame.draw.rect(screen, PLATFORM_DARK, (self.x, self.y, 4, self.height))
-            pygame.draw.rect(screen, PLATFORM_DARK, (self.x + self.width - 4, self.y, 4, self.height))
+            pygame.draw.rect(screen, PLATFORM_DARK, self.left_rect)
+            pygame.draw.rect(screen, PLATFORM_DARK, self.right_rect)
             
     def update_rect(self):
+        # Platforms never move, so every rect the draw needs is built here once
         self.rect = pygame.Rect(self.x, self.y, self.width, self.height)
+        self.grass_rect = pygame.Rect(self.x, self.y, self.width, 8 if self.is_ground else 6)
+        self.shadow_rect = self.rect.move(3, 3)
+        self.left_rect = pygame.Rect(self.x, self.y, 4, self.height)
+        self.right_rect = pygame.Rect(self.x + self.width - 4, self.y, 4, self.height)
+        self.detail_lines = [((self.x + i, self.y + 8), (self.x + i, self.y + self.height))
+                             for i in range(0, self.width, 20)] if self.is_ground else []
+
+
+# --- Collision ---
+# Swept tests: each checks the whole path of a w x h box, so no step is too
+# long to tunnel through a platform. Platforms the box already overlaps are
+# ignored, which lets anything spawned inside one move out of it.
+def sweep_x(x, y, w, h, dx, platforms):
+    # How far the box can move along x before touching a platform side
+    for platform in platforms:
+        if platform.y < y + h and platform.y + platform.height > y:
+            if dx > 0 and x + w <= platform.x < x + w + dx:
+                dx = platform.x - (x + w)
+            elif dx < 0 and x + dx < platform.x + platform.width <= x:
+                dx = platform.x + platform.width - x
+    return dx
+
+
+def sweep_y(x, y, w, h, dy, platforms):
+    # How far the box can move along y before touching a platform top or bottom
+    for platform in platforms:
+        if platform.x < x + w and platform.x + platform.width > x:
+            if dy > 0 and y + h <= platform.y < y + h + dy:
+                dy = platform.y - (y + h)
+            elif dy < 0 and y + dy < platform.y + platform.height <= y:
+                dy = platform.y + platform.height - y
+    return dy
 
 
 # --- Entities ---
+PLAYER_COLORS = [GREEN, (0, 200, 255), ORANGE, (220, 120, 255)]
+GHOST_COLOR = (190, 255, 190)
+
+
 class Player:
-    def __init__(self):
+    def __init__(self, color=GREEN):
+        self.color = color
         self.size = 40
         self.x = 50
         self.y = HEIGHT - 100
@@ -123,6 +392,14 @@ class Player:
         self.double_jumped = False
         self.invincible = 0
         self.animation_frame = 0
+        # Reused every tick instead of building new Rects
+        self.rect = pygame.Rect(self.x, self.y, self.size, self.size)
+        self.body_rect = pygame.Rect(self.rect)
+        self.smile_rect = pygame.Rect(0, 0, 20, 15)
+
+    def sync_rect(self):
+        self.rect.update(self.x, self.y, self.size, self.size)
+        return self.rect
 
     def draw(self):
         # Flashing when invincible
@@ -131,8 +408,9 @@ class Player:
             
         self.animation_frame += 1
         # Body with walking animation
-        body_offset = math.sin(self.animation_frame * 0.2) * 2 if not self.on_ground else 0
-        pygame.draw.rect(screen, GREEN, (self.x, self.y + body_offset, self.size, self.size), border_radius=5)
+        body_offset = math.sin(self.animation_frame * 0.2) * 2 if not self.on_ground and quality.on("bounce") else 0
+        self.body_rect.update(self.x, self.y + body_offset, self.size, self.size)
+        pygame.draw.rect(screen, self.color, self.body_rect, border_radius=quality.radius(5))
         # Eyes
         eye_x = self.x + 10 if self.facing_right else self.x + 25
         eye_y = self.y + 15 + body_offset
@@ -140,58 +418,43 @@ class Player:
         pygame.draw.circle(screen, BLACK, (eye_x, int(eye_y)), 2)
         # Smile
         smile_y = self.y + 30 + body_offset
-        if self.facing_right:
-            pygame.draw.arc(screen, WHITE, (self.x + 10, smile_y - 5, 20, 15), 0, math.pi, 2)
-        else:
-            pygame.draw.arc(screen, WHITE, (self.x + 10, smile_y - 5, 20, 15), 0, math.pi, 2)
+        self.smile_rect.update(self.x + 10, smile_y - 5, 20, 15)
+        pygame.draw.arc(screen, WHITE, self.smile_rect, 0, math.pi, 2)
 
     def jump(self):
         if self.on_ground:
             self.vel_y = -self.jump_power
             self.on_ground = False
-            if jump_sound:
-                jump_sound.play()
+            play_sound(jump_sound)
         elif not self.double_jumped and self.can_double_jump:
             self.vel_y = -self.jump_power * 0.8
             self.double_jumped = True
-            if jump_sound:
-                jump_sound.play()
+            play_sound(jump_sound)
 
-    def update(self, platforms):
+    def move_x(self, dx, platforms):
+        # Walking and knockback stop flush against platform sides
+        self.x += sweep_x(self.x, self.y, self.size, self.size, dx, platforms)
+
+    def update(self, platforms, dt=1):
         # Update invincibility
         if self.invincible > 0:
-            self.invincible -= 1
+            self.invincible -= dt
             
         # Apply gravity
-        self.vel_y += 0.5
+        self.vel_y += 0.5 * dt
         self.vel_y = min(self.vel_y, 15)
         
-        # Move vertically
-        self.y += self.vel_y
+        # Move vertically, stopping at the first platform on the way
+        dy = self.vel_y * dt
+        moved = sweep_y(self.x, self.y, self.size, self.size, dy, platforms)
+        self.y += moved
         self.on_ground = False
-        
-        # Update player rect
-        player_rect = pygame.Rect(self.x, self.y, self.size, self.size)
-        
-        # Platform collision
-        for platform in platforms:
-            if player_rect.colliderect(platform.rect):
-                # Bottom collision (landing on platform)
-                if self.vel_y > 0 and player_rect.bottom > platform.rect.top and player_rect.top < platform.rect.top:
-                    self.y = platform.rect.top - self.size
-                    self.vel_y = 0
-                    self.on_ground = True
-                    self.double_jumped = False
-                # Top collision (hitting head)
-                elif self.vel_y < 0 and player_rect.top < platform.rect.bottom and player_rect.bottom > platform.rect.bottom:
-                    self.y = platform.rect.bottom
-                    self.vel_y = 0
-                # Side collision
-                elif self.vel_y == 0:
-                    if player_rect.right > platform.rect.left and player_rect.left < platform.rect.left:
-                        self.x = platform.rect.left - self.size
-                    elif player_rect.left < platform.rect.right and player_rect.right > platform.rect.right:
-                        self.x = platform.rect.right
+        if moved != dy:
+            if dy > 0:
+                # Landed on a platform
+                self.on_ground = True
+                self.double_jumped = False
+            self.vel_y = 0
 
         # Ground collision
         if self.y > HEIGHT - 50 - self.size:
@@ -220,12 +483,20 @@ class Enemy:
         self.direction = -1
         self.animation_frame = 0
         self.platform = None
+        self.rect = pygame.Rect(x, y, self.size, self.size)
+        self.probe = pygame.Rect(self.rect)
+        self.body_rect = pygame.Rect(self.rect)
+
+    def sync_rect(self):
+        self.rect.update(self.x, self.y, self.size, self.size)
+        return self.rect
 
     def draw(self):
         self.animation_frame += 1
         # Body with idle animation
-        body_offset = math.sin(self.animation_frame * 0.1) * 2
-        pygame.draw.rect(screen, RED, (self.x, self.y + body_offset, self.size, self.size), border_radius=3)
+        body_offset = math.sin(self.animation_frame * 0.1) * 2 if quality.on("bounce") else 0
+        self.body_rect.update(self.x, self.y + body_offset, self.size, self.size)
+        pygame.draw.rect(screen, RED, self.body_rect, border_radius=quality.radius(3))
         # Eyes
         eye_y = self.y + 10 + body_offset
         pygame.draw.circle(screen, WHITE, (int(self.x + 10), int(eye_y)), 6)
@@ -238,22 +509,34 @@ class Enemy:
         pygame.draw.line(screen, BLACK, (self.x + 23, self.y + 5 + body_offset), 
                         (self.x + 27, self.y + 8 + body_offset), 2)
 
-    def update(self, platforms):
-        self.x += self.speed * self.direction
-        
-        # Find current platform
+    def find_platform(self, platforms):
         self.platform = None
-        enemy_rect = pygame.Rect(self.x, self.y + 1, self.size, self.size)
+        enemy_rect = self.probe
+        enemy_rect.update(self.x, self.y + 1, self.size, self.size)
         for platform in platforms:
             if enemy_rect.colliderect(platform.rect):
                 self.platform = platform
                 break
+
+    def update(self, platforms, dt=1):
+        step = self.speed * self.direction * dt
+        dx = sweep_x(self.x, self.y, self.size, self.size, step, platforms)
+        if dx != step:
+            self.direction *= -1  # walked into the side of a platform
+        # Never step past the end of the platform underneath, however long the step
+        self.find_platform(platforms)
+        if self.platform:
+            dx = max(self.platform.x - self.x, min(self.platform.x + self.platform.width - self.size - self.x, dx))
+        self.x += dx
+        
+        # Find current platform
+        self.find_platform(platforms)
         
         # Turn around at platform edges or screen edges
         if self.platform:
             at_left_edge = self.x <= self.platform.x + 5
             at_right_edge = self.x + self.size >= self.platform.x + self.platform.width - 5
-            if at_left_edge or at_right_edge:
+            if (at_left_edge and self.direction < 0) or (at_right_edge and self.direction > 0):
                 self.direction *= -1
         else:
             # If not on a platform, reverse direction
@@ -281,13 +564,14 @@ class Coin:
         self.y = y
         self.animation_time = 0
         self.collected = False
+        self.rect = pygame.Rect(x, y, self.size, self.size)  # coins never move
 
     def draw(self):
         if self.collected:
             return
             
         self.animation_time += 1
-        bounce = math.sin(self.animation_time * 0.1) * 3
+        bounce = math.sin(self.animation_time * 0.1) * 3 if quality.on("bounce") else 0
         rotation = self.animation_time * 5
         
         # Draw coin with rotation effect
@@ -307,6 +591,18 @@ class Coin:
         pygame.draw.circle(screen, WHITE, (int(shine_x), int(shine_y)), 5)
 
 
+_door_glow_cache = {}
+
+
+def door_glow_surface(radius):
+    surface = _door_glow_cache.get(radius)
+    if surface is None:
+        surface = pygame.Surface((radius * 2, radius * 2), pygame.SRCALPHA)
+        pygame.draw.circle(surface, (255, 255, 200, 100), (radius, radius), radius)
+        _door_glow_cache[radius] = surface
+    return surface
+
+
 class Door:
     def __init__(self, x, y):
         self.x = x
@@ -315,53 +611,381 @@ class Door:
         self.height = 60
         self.animation_frame = 0
         self.platform = None
+        # Doors never move, so build every rect the draw needs once
+        self.rect = pygame.Rect(x, y, self.width, self.height)
+        self.shadow_rect = self.rect.move(2, 2)
+        self.panel_rect = self.rect.inflate(-6, -6)
+        self.detail_rect = pygame.Rect(x + self.width//2 - 5, y + 10, 10, self.height - 20)
+        self.handle_pos = (x + self.width - 8, y + self.height//2)
+        self.sparkle_area = (self.width - 10, self.height - 10)
+        self.glow_rect = pygame.Rect(0, 0, 0, 0)
         
-    def draw(self):
-        self.animation_frame += 1
+    def draw(self, ticks=1):
+        self.animation_frame += ticks
         glow = math.sin(self.animation_frame * 0.1) * 5
         
-        # Door glow effect
-        pygame.draw.circle(screen, (255, 255, 200, 100), 
-                          (self.x + self.width//2, self.y + self.height//2), 
-                          40 + glow)
+        # Door glow effect (the screen has no alpha, so blend a cached alpha surface)
+        glow_surface = door_glow_surface(int(40 + glow))
+        self.glow_rect.size = glow_surface.get_size()
+        self.glow_rect.center = self.rect.center
+        screen.blit(glow_surface, self.glow_rect)
         
         # Door frame with shadow
-        pygame.draw.rect(screen, DOOR_BROWN, (self.x + 2, self.y + 2, self.width, self.height))
-        pygame.draw.rect(screen, (150, 100, 50), (self.x, self.y, self.width, self.height))
+        pygame.draw.rect(screen, DOOR_BROWN, self.shadow_rect)
+        pygame.draw.rect(screen, (150, 100, 50), self.rect)
         
         # Door panel
-        pygame.draw.rect(screen, (120, 80, 40), (self.x + 3, self.y + 3, self.width - 6, self.height - 6))
+        pygame.draw.rect(screen, (120, 80, 40), self.panel_rect)
         
         # Door details
-        pygame.draw.rect(screen, (100, 60, 20), (self.x + self.width//2 - 5, self.y + 10, 10, self.height - 20))
+        pygame.draw.rect(screen, (100, 60, 20), self.detail_rect)
         
         # Door handle
-        handle_y = self.y + self.height//2
-        pygame.draw.circle(screen, DOOR_YELLOW, (self.x + self.width - 8, handle_y), 4)
-        pygame.draw.circle(screen, (200, 150, 0), (self.x + self.width - 8, handle_y), 2)
+        pygame.draw.circle(screen, DOOR_YELLOW, self.handle_pos, 4)
+        pygame.draw.circle(screen, (200, 150, 0), self.handle_pos, 2)
         
         # Magic sparkles
-        for i in range(3):
-            sparkle_x = self.x + random.randint(5, self.width - 5)
-            sparkle_y = self.y + random.randint(5, self.height - 5)
-            if random.random() < 0.3:
-                pygame.draw.circle(screen, (255, 255, 200), (sparkle_x, sparkle_y), 2)
+        if quality.on("sparkles"):
+            particles.emit(self.x + 5, self.y + 5, 0.9 * ticks, area=self.sparkle_area,
+                           speed=0.3, life=(15, 30), colors=SPARKLE_COLORS, gravity=-0.02)
                 
     def get_rect(self):
-        return pygame.Rect(self.x, self.y, self.width, self.height)
+        return self.rect
+
+
+# --- Particles ---
+PARTICLE_CHUNK = 4096                    # particles per vectorised step
+PARTICLE_CAPACITY = 5 * PARTICLE_CHUNK    # a full system draws and updates in under 1.5 ms
+
+
+def particle_palette(colors):
+    # Particle colors are stored packed as 0xRRGGBB
+    rgb = np.asarray(colors, np.uint32).reshape(-1, 3)
+    return (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+
+
+SPARKLE_COLORS = particle_palette([(255, 255, 200)])
+COIN_COLORS = particle_palette([YELLOW, ORANGE, WHITE])
+DAMAGE_COLORS = particle_palette([RED, ORANGE, (120, 0, 0)])
+DOOR_BURST_COLORS = particle_palette([(255, 255, 200), DOOR_YELLOW, WHITE])
+VICTORY_COLORS = particle_palette([(255, 255, 200), YELLOW, WHITE])
+
+
+class ParticleSystem:
+    # Struct-of-arrays storage used as a ring: emit() writes at a cursor that
+    # wraps around, overwriting the oldest slots, so nothing is ever compacted.
+    # Work is done a chunk at a time, and only for chunks that may still hold
+    # a live particle. Chunk views and scratch arrays are all made here, so
+    # updating and drawing a frame allocates next to nothing.
+    def __init__(self, capacity=PARTICLE_CAPACITY):
+        self.capacity = capacity
+        self.pos = np.zeros((capacity, 2), np.float32)
+        self.vel = np.zeros((capacity, 2), np.float32)
+        self.gravity = np.zeros(capacity, np.float32)
+        self.life = np.zeros(capacity, np.float32)
+        self.max_life = np.ones(capacity, np.float32)
+        self.color = np.zeros(capacity, np.uint32)
+        self.next = 0
+        self.ticks = 0
+        self.expiry = [0] * (capacity // PARTICLE_CHUNK)  # tick by which each chunk is all dead
+        self.rng = np.random.default_rng()
+        self.chunks = []
+        for i in range(0, capacity, PARTICLE_CHUNK):
+            j = i + PARTICLE_CHUNK
+            self.chunks.append((self.pos[i:j], self.vel[i:j], self.vel[i:j, 1], self.pos[i:j, 0], self.pos[i:j, 1],
+                                self.gravity[i:j], self.life[i:j], self.max_life[i:j], self.color[i:j]))
+        # Scratch for one chunk
+        self.floats = [np.zeros(PARTICLE_CHUNK, np.float32) for _ in range(3)]
+        self.xs = np.zeros(PARTICLE_CHUNK, np.intp)
+        self.ys = np.zeros(PARTICLE_CHUNK, np.intp)
+        self.index = np.zeros(PARTICLE_CHUNK, np.intp)
+        self.at = np.zeros(PARTICLE_CHUNK, np.intp)
+        self.hidden = np.zeros(PARTICLE_CHUNK, bool)
+        self.mask = np.zeros(PARTICLE_CHUNK, bool)
+        self.alpha = np.zeros(PARTICLE_CHUNK, np.uint32)
+        self.inverse = np.zeros(PARTICLE_CHUNK, np.uint32)
+        self.red_blue = np.zeros(PARTICLE_CHUNK, np.uint32)
+        self.green = np.zeros(PARTICLE_CHUNK, np.uint32)
+        self.under = np.zeros(PARTICLE_CHUNK, np.uint32)
+        self.blend = np.zeros(PARTICLE_CHUNK, np.uint32)
+        # Negative coordinates wrap to huge values here, so one compare bounds both ends
+        self.unsigned_xs = self.xs.view(np.uintp)
+        self.unsigned_ys = self.ys.view(np.uintp)
+
+    def clear(self):
+        self.life[:] = 0
+        self.expiry = [0] * len(self.expiry)
+        self.next = 0
+
+    def emit(self, x, y, n, area=(0, 0), speed=2.0, life=(20, 40), colors=(WHITE,), gravity=0.0):
+        # n may be fractional: the remainder is emitted with that probability
+        n = int(n) + (random.random() < n - int(n))
+        n = min(n, self.capacity)
+        if n <= 0:
+            return
+        palette = colors if isinstance(colors, np.ndarray) else particle_palette(colors)
+        if n == 1:
+            # Trickle emitters (door sparkles) add one particle a frame; plain
+            # scalar writes are cheaper than a dozen array operations for that
+            i = self.next
+            angle = random.random() * (2 * math.pi)
+            magnitude = random.random() * speed
+            self.pos[i, 0] = x + random.random() * area[0]
+            self.pos[i, 1] = y + random.random() * area[1]
+            self.vel[i, 0] = math.cos(angle) * magnitude
+            self.vel[i, 1] = math.sin(angle) * magnitude
+            self.gravity[i] = gravity
+            self.life[i] = self.max_life[i] = random.randint(life[0], life[1])
+            self.color[i] = palette[random.randrange(len(palette))]
+            self._claim(i, 1, life[1])
+            return
+        # Fill in runs that stay inside one chunk, so one chunk of scratch is enough
+        while n:
+            i = self.next
+            m = min(n, PARTICLE_CHUNK - i % PARTICLE_CHUNK)
+            self._emit_run(i, i + m, x, y, area, speed, life, palette, gravity)
+            self._claim(i, m, life[1])
+            n -= m
+
+    def _emit_run(self, i, j, x, y, area, speed, life, palette, gravity):
+        m = j - i
+        rng = self.rng
+        r, angle, magnitude = (f[:m] for f in self.floats)
+        rng.random(out=r, dtype=np.float32)
+        r *= area[0]
+        np.add(r, x, self.pos[i:j, 0])
+        rng.random(out=r, dtype=np.float32)
+        r *= area[1]
+        np.add(r, y, self.pos[i:j, 1])
+        rng.random(out=angle, dtype=np.float32)
+        angle *= 2 * math.pi
+        rng.random(out=magnitude, dtype=np.float32)
+        magnitude *= speed
+        np.cos(angle, r)
+        np.multiply(r, magnitude, self.vel[i:j, 0])
+        np.sin(angle, r)
+        np.multiply(r, magnitude, self.vel[i:j, 1])
+        self.gravity[i:j] = gravity
+        # Whole lifetimes in [life[0], life[1]]
+        rng.random(out=r, dtype=np.float32)
+        r *= life[1] - life[0] + 1
+        np.floor(r, r)
+        r += life[0]
+        np.minimum(r, life[1], out=self.life[i:j])
+        self.max_life[i:j] = self.life[i:j]
+        rng.random(out=r, dtype=np.float32)
+        r *= len(palette)
+        picks = self.at[:m]
+        np.copyto(picks, r, "unsafe")
+        palette.take(picks, None, self.color[i:j], "clip")
+
+    def _claim(self, i, n, longest_life):
+        c = i // PARTICLE_CHUNK
+        self.expiry[c] = max(self.expiry[c], self.ticks + longest_life)
+        self.next = (i + n) % self.capacity
+
+    def burst(self, x, y, n, colors, speed=4.0, life=(20, 45), gravity=0.15):
+        if not effects_enabled:
+            return
+        if deferred_effects is not None:
+            deferred_effects.put((self.emit, (x, y, n, (0, 0), speed, life, colors, gravity)))
+            return
+        self.emit(x, y, n, speed=speed, life=life, colors=colors, gravity=gravity)
+
+    def update(self):
+        # Dead particles in an active chunk keep moving; they are never drawn
+        for expiry, (pos, vel, vel_y, _, _, gravity, life, _, _) in zip(self.expiry, self.chunks):
+            if expiry > self.ticks:
+                vel_y += gravity
+                pos += vel
+                life -= 1
+        self.ticks += 1
+
+    def draw(self, surface):
+        w, h = surface.get_size()
+        red_shift, green_shift, blue_shift, _ = surface.get_shifts()
+        packed = (surface.get_bytesize() == 4 and surface.get_pitch() == w * 4 and green_shift == 8 and
+                  (red_shift, blue_shift) in ((16, 0), (0, 16)))
+        pixels = None
+        xs, ys, hidden, mask, alpha, fade = self.xs, self.ys, self.hidden, self.mask, self.alpha, self.floats[0]
+        for expiry, (_, _, _, pos_x, pos_y, _, life, max_life, color) in zip(self.expiry, self.chunks):
+            if expiry <= self.ticks:
+                continue
+            np.copyto(xs, pos_x, "unsafe")
+            np.copyto(ys, pos_y, "unsafe")
+            np.greater_equal(self.unsigned_xs, w - 1, hidden)
+            np.greater_equal(self.unsigned_ys, h - 1, mask)
+            hidden |= mask
+            np.less_equal(life, 0, mask)
+            hidden |= mask
+            # Fade out over the last half of the lifetime, with alpha in 0..256
+            np.multiply(life, 512, fade)
+            np.floor_divide(fade, max_life, fade)
+            np.minimum(fade, 256, out=fade)
+            np.copyto(alpha, fade, "unsafe")
+            np.copyto(alpha, 0, where=hidden)
+            if not packed:
+                self.draw_any(surface, color)
+                continue
+            if pixels is None:
+                pixels = np.frombuffer(surface.get_view("1"), np.uint32)
+            self.draw_packed(pixels, w, red_shift, color)
+        del pixels  # unlocks the surface
+
+    def draw_packed(self, pixels, stride, red_shift, color):
+        # Red and blue sit 16 bits apart in XRGB/XBGR pixels, so both blend in
+        # one integer multiply and green gets a second. Hidden particles blend
+        # pixel 0 with alpha 0, which leaves it as it was.
+        index, at, alpha, inverse = self.index, self.at, self.alpha, self.inverse
+        red_blue, green, under, blend = self.red_blue, self.green, self.under, self.blend
+        np.multiply(self.ys, stride, index)
+        index += self.xs
+        np.copyto(index, 0, where=self.hidden)
+        np.subtract(256, alpha, inverse)
+        if red_shift == 16:
+            np.bitwise_and(color, 0xFF00FF, red_blue)
+        else:
+            np.right_shift(color, 16, red_blue)
+            np.left_shift(color, 16, blend)
+            red_blue |= blend
+            red_blue &= 0xFF00FF
+        red_blue *= alpha
+        np.bitwise_and(color, 0x00FF00, green)
+        green *= alpha
+        for offset in (0, 1, stride, stride + 1):
+            np.add(index, offset, at)
+            pixels.take(at, None, under, "clip")
+            np.bitwise_and(under, 0xFF00FF, blend)
+            blend *= inverse
+            blend += red_blue
+            blend >>= 8
+            blend &= 0xFF00FF
+            under &= 0x00FF00
+            under *= inverse
+            under += green
+            under >>= 8
+            under &= 0x00FF00
+            under |= blend
+            pixels.put(at, under)
+
+    def draw_any(self, surface, color):
+        # Slower path for pixel formats draw_packed cannot handle
+        visible = ~self.hidden
+        xs, ys = self.xs[visible], self.ys[visible]
+        alpha = (self.alpha[visible] / 256)[:, None]
+        packed = color[visible]
+        color = np.stack((packed >> 16, (packed >> 8) & 0xFF, packed & 0xFF), axis=1) * alpha
+        pixels = pygame.surfarray.pixels3d(surface)
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            under = pixels[xs + dx, ys + dy]
+            pixels[xs + dx, ys + dy] = under * (1 - alpha) + color
+        del pixels  # unlocks the surface
+
+
+# --- Quality ---
+# Optional effects, cheapest to lose first. At quality level L the first
+# len(QUALITY_EFFECTS) - L of them are switched off.
+QUALITY_EFFECTS = ("clouds", "sparkles", "glow", "bounce", "rounded", "mountains")
+
+
+class QualityGovernor:
+    # Steps quality down quickly when frames run over budget and back up
+    # slowly once there is clear headroom, so it does not oscillate.
+    def __init__(self, budget=1 / FPS, down_after=15, up_after=180, headroom=0.6):
+        self.budget = budget
+        self.down_after = down_after
+        self.up_after = up_after
+        self.headroom = headroom
+        self.max_level = len(QUALITY_EFFECTS)
+        self.level = self.max_level
+        self.frame_time = 0.0  # smoothed work time per frame, in seconds
+        self.slow_frames = 0
+        self.fast_frames = 0
+        self.indicators = {}
+        self._set_level(self.max_level)
+
+    def _set_level(self, level):
+        self.level = level
+        off = self.max_level - level
+        self.enabled = {effect: i >= off for i, effect in enumerate(QUALITY_EFFECTS)}
+        self.slow_frames = self.fast_frames = 0
+
+    def on(self, effect):
+        return self.enabled[effect]
+
+    def radius(self, radius):
+        return radius if self.enabled["rounded"] else 0
+
+    def frame(self, work_time):
+        self.frame_time += (work_time - self.frame_time) * 0.1
+        if self.frame_time > self.budget:
+            self.slow_frames += 1
+            self.fast_frames = 0
+        elif self.frame_time < self.budget * self.headroom:
+            self.fast_frames += 1
+            self.slow_frames = 0
+        else:
+            self.slow_frames = self.fast_frames = 0
+
+        if self.slow_frames >= self.down_after and self.level > 0:
+            self._set_level(self.level - 1)
+        elif self.fast_frames >= self.up_after and self.level < self.max_level:
+            self._set_level(self.level + 1)
+
+    def draw_indicator(self, surface):
+        indicator = self.indicators.get(self.level)
+        if indicator is None:
+            share = self.level / self.max_level
+            color = GREEN if share > 0.6 else YELLOW if share > 0.3 else RED
+            indicator = font.render(f"Q{self.level}", True, color)
+            self.indicators[self.level] = indicator
+        surface.blit(indicator, (surface.get_width() - indicator.get_width() - 8,
+                                 surface.get_height() - indicator.get_height() - 4))
 
 
 # --- Game Manager ---
+_sky_cache = {}
+
+
+def sky_surface():
+    # The gradient only depends on the window size, so draw it once per size
+    surface = _sky_cache.get((WIDTH, HEIGHT))
+    if surface is None:
+        _sky_cache.clear()
+        surface = pygame.Surface((WIDTH, HEIGHT))
+        for i in range(HEIGHT):
+            color_factor = i / HEIGHT
+            color = (
+                int(SKY_BLUE[0] * (1 - color_factor) + 100 * color_factor),
+                int(SKY_BLUE[1] * (1 - color_factor) + 150 * color_factor),
+                int(SKY_BLUE[2] * (1 - color_factor) + 200 * color_factor)
+            )
+            pygame.draw.line(surface, color, (0, i), (WIDTH, i))
+        _sky_cache[(WIDTH, HEIGHT)] = surface
+    return surface
+
+
+INPUT_LEFT = 1
+INPUT_RIGHT = 2
+INPUT_JUMP = 4  # set only on the tick the jump key went down
+
+
 class Game:
-    def __init__(self):
-        self.reset_full()
+    def __init__(self, seed=None):
+        self.reset_full(seed)
         self.state = "main_menu"
         self.from_pause = False
         self.camera_x = 0
         self.max_levels = 5
 
-    def reset_full(self):
+    def reset_full(self, seed=None):
+        # Everything random in the simulation comes from the seed, so the same
+        # seed and inputs replay the same run (ghosts, netplay)
+        self.seed = random.randrange(2**31) if seed is None else seed
+        self.rng = random.Random(self.seed)
         self.player = Player()
+        self.players = [self.player]
+        self.local_player = 0
         self.enemies = []
         self.coins = []
         self.platforms = []
@@ -369,11 +993,13 @@ class Game:
         self.level = 1
         self.enemy_timer = 0
         self.coin_timer = 0
+        self.ticks = 0
         self.generate_level()
-        if monster_sound:
-            monster_sound.stop()
+        stop_sound(monster_sound)
 
     def generate_level(self):
+        # Layouts depend only on seed and level, not on how long earlier levels took
+        rng = random.Random(self.seed * 1000 + self.level)
         self.platforms = []
         self.coins = []
         
@@ -422,8 +1048,8 @@ class Game:
                 
             # More coins
             for i in range(6):
-                platform = random.choice(self.platforms[1:])
-                coin_x = platform.x + random.randint(20, platform.width - 40)
+                platform = rng.choice(self.platforms[1:])
+                coin_x = platform.x + rng.randint(20, platform.width - 40)
                 coin_y = platform.y - 30
                 self.coins.append(Coin(coin_x, coin_y))
                 
@@ -446,15 +1072,15 @@ class Game:
                 if i == num_platforms - 1:
                     # Last platform for door
                     x = WIDTH - 150
-                    y = random.randint(min_y, max_y - 50)
+                    y = rng.randint(min_y, max_y - 50)
                     width = 150
                 else:
-                    x = prev_x + random.randint(100, 200)
-                    y = random.randint(min_y, max_y)
+                    x = prev_x + rng.randint(100, 200)
+                    y = rng.randint(min_y, max_y)
                     # Ensure platforms are reachable
                     if abs(y - prev_y) > 100:
-                        y = prev_y + random.choice([-80, -60, -40, 40, 60, 80])
-                    width = random.randint(80, 140)
+                        y = prev_y + rng.choice([-80, -60, -40, 40, 60, 80])
+                    width = rng.randint(80, 140)
                 
                 platform = Platform(x, y, width)
                 self.platforms.append(platform)
@@ -464,8 +1090,8 @@ class Game:
             
             # Add coins
             for i in range(4 + self.level):
-                platform = random.choice(self.platforms[1:])
-                coin_x = platform.x + random.randint(20, platform.width - 40)
+                platform = rng.choice(self.platforms[1:])
+                coin_x = platform.x + rng.randint(20, platform.width - 40)
                 coin_y = platform.y - 30
                 self.coins.append(Coin(coin_x, coin_y))
             
@@ -475,13 +1101,12 @@ class Game:
                            door_platform.y - 60)
         else:
             # Final level
-            self.generate_final_level()
+            self.generate_final_level(rng)
         
-        if monster_sound:
-            monster_sound.stop()
+        stop_sound(monster_sound)
         self.enemies.clear()
         
-    def generate_final_level(self):
+    def generate_final_level(self, rng):
         # Boss level
         platforms_data = [
             (100, HEIGHT - 200, 100),
@@ -497,8 +1122,8 @@ class Game:
             
         # Lots of coins
         for i in range(10):
-            platform = random.choice(self.platforms[1:])
-            coin_x = platform.x + random.randint(20, platform.width - 40)
+            platform = rng.choice(self.platforms[1:])
+            coin_x = platform.x + rng.randint(20, platform.width - 40)
             coin_y = platform.y - 30
             self.coins.append(Coin(coin_x, coin_y))
             
@@ -507,41 +1132,55 @@ class Game:
         self.door = Door(door_platform.x + door_platform.width//2 - 15,
                        door_platform.y - 60)
 
-    def draw_background(self):
+    def draw_background(self, now=None):
+        # now is the animation clock in ms; replay rendering passes one derived
+        # from the tick so frames do not depend on wall time
+        if now is None:
+            now = pygame.time.get_ticks()
         # Sky gradient
-        for i in range(HEIGHT):
-            color_factor = i / HEIGHT
-            color = (
-                int(SKY_BLUE[0] * (1 - color_factor) + 100 * color_factor),
-                int(SKY_BLUE[1] * (1 - color_factor) + 150 * color_factor),
-                int(SKY_BLUE[2] * (1 - color_factor) + 200 * color_factor)
-            )
-            pygame.draw.line(screen, color, (0, i), (WIDTH, i))
+        screen.blit(sky_surface(), (0, 0))
         
         # Distant mountains
-        for i in range(3):
-            mountain_x = (i * WIDTH // 3) - (pygame.time.get_ticks() // 100) % (WIDTH // 3)
-            points = [
-                (mountain_x, HEIGHT - 100),
-                (mountain_x + 100, HEIGHT - 250),
-                (mountain_x + 200, HEIGHT - 100)
-            ]
-            color = (100 - i*20, 120 - i*20, 140 - i*20)
-            pygame.draw.polygon(screen, color, points)
+        if quality.on("mountains"):
+            for i in range(3):
+                mountain_x = (i * WIDTH // 3) - (now // 100) % (WIDTH // 3)
+                points = [
+                    (mountain_x, HEIGHT - 100),
+                    (mountain_x + 100, HEIGHT - 250),
+                    (mountain_x + 200, HEIGHT - 100)
+                ]
+                color = (100 - i*20, 120 - i*20, 140 - i*20)
+                pygame.draw.polygon(screen, color, points)
         
         # Clouds
-        for i in range(4):
-            cloud_x = (pygame.time.get_ticks() // 80 + i * 250) % (WIDTH + 400) - 200
-            cloud_y = 60 + i * 40
-            cloud_size = 25 + i * 5
-            pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x), cloud_y), cloud_size)
-            pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x + cloud_size*0.8), cloud_y - 10), cloud_size*0.8)
-            pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x + cloud_size*0.8), cloud_y + 10), cloud_size*0.8)
+        if quality.on("clouds"):
+            for i in range(4):
+                cloud_x = (now // 80 + i * 250) % (WIDTH + 400) - 200
+                cloud_y = 60 + i * 40
+                cloud_size = 25 + i * 5
+                pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x), cloud_y), cloud_size)
+                pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x + cloud_size*0.8), cloud_y - 10), cloud_size*0.8)
+                pygame.draw.circle(screen, (240, 240, 240), (int(cloud_x + cloud_size*0.8), cloud_y + 10), cloud_size*0.8)
 
     def draw_platforms(self):
         for platform in self.platforms:
             platform.draw()
 
+    def draw_world(self, now=None):
+        # Everything that goes under the players
+        self.draw_background(now)
+        self.draw_platforms()
+        if self.door:
+            self.door.draw()
+        for coin in self.coins:
+            coin.draw()
+        for enemy in self.enemies:
+            enemy.draw()
+
+    def draw_players(self):
+        for player in self.players:
+            player.draw()
+
     def draw_ui(self):
         # Health bar
         health_width = 200
@@ -550,9 +1189,10 @@ class Game:
         health_y = 10
         
         # Background
-        pygame.draw.rect(screen, (40, 40, 40), (health_x, health_y, health_width, health_height), border_radius=4)
+        pygame.draw.rect(screen, (40, 40, 40), (health_x, health_y, health_width, health_height), border_radius=quality.radius(4))
         # Health fill
-        health_percent = self.player.health / 100
+        player = self.players[self.local_player]
+        health_percent = player.health / 100
         fill_width = max(0, int(health_width * health_percent))
         if health_percent > 0.6:
             health_color = GREEN
@@ -560,140 +1200,819 @@ class Game:
             health_color = YELLOW
         else:
             health_color = RED
-        pygame.draw.rect(screen, health_color, (health_x, health_y, fill_width, health_height), border_radius=4)
+        pygame.draw.rect(screen, health_color, (health_x, health_y, fill_width, health_height), border_radius=quality.radius(4))
         # Border
-        pygame.draw.rect(screen, BLACK, (health_x, health_y, health_width, health_height), 2, border_radius=4)
-        # Health text
-        health_text = font.render(f"{self.player.health}/100", True, WHITE)
-        screen.blit(health_text, (health_x + health_width + 10, health_y))
-        
-        # Coins display with icon
-        coin_icon = font.render("🪙", True, YELLOW)
-        screen.blit(coin_icon, (WIDTH - 180, 12))
-        coin_text = font.render(f"{self.player.coins}", True, WHITE)
-        screen.blit(coin_text, (WIDTH - 150, 10))
-        
-        # Level display
-        level_text = font.render(f"Level {self.level}/{self.max_levels}", True, WHITE)
-        screen.blit(level_text, (WIDTH // 2 - level_text.get_width() // 2, 10))
-        
-        # Controls hint
+        pygame.draw.rect(screen, BLACK, (health_x, health_y, health_width, health_height), 2, border_radius=quality.radius(4))
+        # Text, coin icon, level and controls hint are retained widgets
+        hud = get_ui("hud", None, build_hud_ui)
+        hud.named["health"].set_text(f"{player.health}/100")
+        hud.named["coins"].set_text(f"{player.coins}")
+        hud.named["level"].set_text(f"Level {self.level}/{self.max_levels}")
+        hud.update(pygame.mouse.get_pos())
+        hud.draw(screen)
+
+    def add_player(self):
+        player = Player(PLAYER_COLORS[len(self.players) % len(PLAYER_COLORS)])
+        self.players.append(player)
+        return player
+
+    def apply_input(self, player, bits, dt=1):
+        if bits & INPUT_JUMP:
+            player.jump()
+        if bits & INPUT_LEFT:
+            player.move_x(-player.speed * dt, self.platforms)
+            player.facing_right = False
+        if bits & INPUT_RIGHT:
+            player.move_x(player.speed * dt, self.platforms)
+            player.facing_right = True
+
+    def step(self, inputs, dt=1):
+        # One simulation tick; inputs holds an INPUT_* bitmask per player and
+        # a longer list than there are players means someone joined this tick.
+        # dt > 1 advances that many ticks at once for coarse headless runs;
+        # recordings and netplay always step with dt=1 so they replay exactly.
+        while len(self.players) < len(inputs):
+            self.add_player()
         if self.state == "playing":
-            controls = [
-                "← →: Move",
-                "SPACE: Jump",
-                "ESC: Menu"
-            ]
-            for i, control in enumerate(controls):
-                control_text = font.render(control, True, (200, 200, 200))
-                screen.blit(control_text, (10, HEIGHT - 80 + i * 25))
+            for player, bits in zip(self.players, inputs):
+                self.apply_input(player, bits, dt)
+        self.update(dt)
 
-    def update(self):
+    def update(self, dt=1):
         if self.state != "playing":
             return
         
-        self.player.update(self.platforms)
+        self.ticks += dt
+        for player in self.players:
+            player.update(self.platforms, dt)
         
         # Spawn enemies with increasing difficulty
-        self.enemy_timer += 1
+        self.enemy_timer += dt
         spawn_rate = max(50, 200 - (self.level * 20))
         if self.enemy_timer >= spawn_rate and len(self.enemies) < 3 + self.level // 2:
             self.spawn_enemy()
             self.enemy_timer = 0
         
         # Spawn coins
-        self.coin_timer += 1
+        self.coin_timer += dt
         if self.coin_timer >= 400 and len(self.coins) < 8 + self.level:
             self.spawn_coin()
             self.coin_timer = 0
         
-        # Update enemies
-        for enemy in self.enemies[:]:
-            enemy.update(self.platforms)
+        # Update enemies (index loops so nothing is copied per tick)
+        enemies = self.enemies
+        i = 0
+        while i < len(enemies):
+            enemy = enemies[i]
+            enemy.update(self.platforms, dt)
             
             # Remove off-screen enemies
             if enemy.x < -100 or enemy.x > WIDTH + 100:
-                self.enemies.remove(enemy)
+                del enemies[i]
                 continue
+            i += 1
             
-            # Enemy collision with player
-            player_rect = pygame.Rect(self.player.x, self.player.y, self.player.size, self.player.size)
-            enemy_rect = pygame.Rect(enemy.x, enemy.y, enemy.size, enemy.size)
-            if player_rect.colliderect(enemy_rect):
-                if self.player.take_damage(10):
-                    # Knockback effect
-                    if self.player.x < enemy.x:
-                        self.player.x -= 30
-                    else:
-                        self.player.x += 30
-                    
-                    if self.player.health <= 0:
-                        self.state = "game_over"
+            # Enemy collision with players
+            enemy_rect = enemy.sync_rect()
+            for player in self.players:
+                if player.sync_rect().colliderect(enemy_rect):
+                    if player.take_damage(10):
+                        particles.burst(player.x + player.size // 2, player.y + player.size // 2,
+                                        80, DAMAGE_COLORS)
+                        # Knockback effect
+                        if player.x < enemy.x:
+                            player.move_x(-30, self.platforms)
+                        else:
+                            player.move_x(30, self.platforms)
+                        
+                        if player.health <= 0:
+                            self.state = "game_over"
         
         # Coin collection
-        for coin in self.coins[:]:
+        coins = self.coins
+        i = 0
+        while i < len(coins):
+            coin = coins[i]
             if coin.collected:
-                self.coins.remove(coin)
+                del coins[i]
                 continue
+            i += 1
                 
-            player_rect = pygame.Rect(self.player.x, self.player.y, self.player.size, self.player.size)
-            coin_rect = pygame.Rect(coin.x, coin.y, coin.size, coin.size)
-            if player_rect.colliderect(coin_rect):
-                coin.collected = True
-                self.player.coins += 1
-                if coin_sound:
-                    coin_sound.play()
+            for player in self.players:
+                if player.sync_rect().colliderect(coin.rect):
+                    coin.collected = True
+                    player.coins += 1
+                    particles.burst(coin.x + coin.size // 2, coin.y + coin.size // 2,
+                                    60, COIN_COLORS, speed=3.0)
+                    play_sound(coin_sound)
+                    break
         
         # Door collision (level completion)
         if self.door:
-            player_rect = pygame.Rect(self.player.x, self.player.y, self.player.size, self.player.size)
-            door_rect = self.door.get_rect()
-            if player_rect.colliderect(door_rect):
-                self.complete_level()
+            for player in self.players:
+                if player.sync_rect().colliderect(self.door.rect):
+                    self.complete_level()
+                    break
     
     def spawn_enemy(self):
         if len(self.platforms) > 1:
-            platform = random.choice(self.platforms[1:])
-            spawn_x = platform.x + random.randint(20, max(20, platform.width - 55))
+            platform = self.rng.choice(self.platforms[1:])
+            spawn_x = platform.x + self.rng.randint(20, max(20, platform.width - 55))
             spawn_y = platform.y - 35
             speed = 1.5 + (self.level * 0.3)
             self.enemies.append(Enemy(spawn_x, spawn_y, speed))
-            if monster_sound:
-                monster_sound.play()
+            play_sound(monster_sound)
     
     def spawn_coin(self):
         if len(self.platforms) > 1:
-            platform = random.choice(self.platforms[1:])
-            coin_x = platform.x + random.randint(20, max(20, platform.width - 40))
+            platform = self.rng.choice(self.platforms[1:])
+            coin_x = platform.x + self.rng.randint(20, max(20, platform.width - 40))
             coin_y = platform.y - 30
             self.coins.append(Coin(coin_x, coin_y))
     
     def complete_level(self):
-        if door_sound:
-            door_sound.play()
+        if self.door:
+            particles.burst(self.door.x + self.door.width // 2, self.door.y + self.door.height // 2,
+                            400, DOOR_BURST_COLORS, speed=6.0, life=(30, 60), gravity=0.05)
+        play_sound(door_sound)
             
-        if monster_sound:
-            monster_sound.stop()
+        stop_sound(monster_sound)
             
         if self.level >= self.max_levels:
             self.state = "victory"
         else:
             self.level += 1
-            self.player.x, self.player.y = 50, HEIGHT - 100
-            self.player.health = min(100, self.player.health + 25)  # Heal on level completion
-            self.player.coins += 5  # Bonus coins for completing level
+            for player in self.players:
+                player.x, player.y = 50, HEIGHT - 100
+                player.health = min(100, player.health + 25)  # Heal on level completion
+                player.coins += 5  # Bonus coins for completing level
             self.enemy_timer = 0
             self.coin_timer = 0
             self.generate_level()
 
+    def snapshot(self, include_rng=False):
+        # Flat dict of plain values so consecutive ticks diff cheaply.
+        # Draw-only animation counters are left out on purpose. The RNG is
+        # only included when asked for, since only resimulation needs it.
+        snap = {
+            "state": self.state,
+            "level": self.level,
+            "timers": (self.enemy_timer, self.coin_timer, self.ticks),
+            "player_count": len(self.players),
+            "platforms": tuple((pl.x, pl.y, pl.width, pl.height, pl.is_ground) for pl in self.platforms),
+            "door": (self.door.x, self.door.y) if self.door else None,
+            "enemy_count": len(self.enemies),
+            "coin_count": len(self.coins),
+        }
+        for i, p in enumerate(self.players):
+            snap[("player", i)] = (p.x, p.y, p.health, p.coins, p.facing_right, p.vel_y,
+                                   p.on_ground, p.double_jumped, p.invincible)
+        for i, enemy in enumerate(self.enemies):
+            snap[("enemy", i)] = (enemy.x, enemy.y, enemy.speed, enemy.direction)
+        for i, coin in enumerate(self.coins):
+            snap[("coin", i)] = (coin.x, coin.y, coin.collected)
+        if include_rng:
+            # Split the Mersenne Twister words into chunks: between spawns only
+            # the position moves, so rewind deltas carry a few bytes, not 2.5 KB
+            version, words, gauss = self.rng.getstate()
+            snap["rng"] = (version, words[-1], gauss)
+            for i in range(0, len(words) - 1, RNG_SNAPSHOT_CHUNK):
+                snap[("rng", i)] = words[i:i + RNG_SNAPSHOT_CHUNK]
+        return snap
+
+    def restore(self, snap):
+        self.state = snap["state"]
+        self.level = snap["level"]
+        self.enemy_timer, self.coin_timer, self.ticks = snap["timers"]
+        del self.players[snap["player_count"]:]
+        while len(self.players) < snap["player_count"]:
+            self.add_player()
+        for i, p in enumerate(self.players):
+            (p.x, p.y, p.health, p.coins, p.facing_right, p.vel_y,
+             p.on_ground, p.double_jumped, p.invincible) = snap[("player", i)]
+        if "rng" in snap:
+            version, position, gauss = snap["rng"]
+            words = sum((snap[("rng", i)] for i in range(0, 624, RNG_SNAPSHOT_CHUNK)), ())  # 624-word state
+            self.rng.setstate((version, words + (position,), gauss))
+
+        # Platforms only change between levels, so keep the objects when we can
+        platforms = tuple((pl.x, pl.y, pl.width, pl.height, pl.is_ground) for pl in self.platforms)
+        if platforms != snap["platforms"]:
+            self.platforms = [Platform(x, y, w, h, is_ground=g) for x, y, w, h, g in snap["platforms"]]
+
+        if snap["door"] is None:
+            self.door = None
+        elif self.door is None or (self.door.x, self.door.y) != snap["door"]:
+            self.door = Door(*snap["door"])
+
+        self.enemies = []
+        for i in range(snap["enemy_count"]):
+            x, y, speed, direction = snap[("enemy", i)]
+            enemy = Enemy(x, y, speed)
+            enemy.direction = direction
+            self.enemies.append(enemy)
+
+        self.coins = []
+        for i in range(snap["coin_count"]):
+            x, y, collected = snap[("coin", i)]
+            coin = Coin(x, y)
+            coin.collected = collected
+            self.coins.append(coin)
+
+    def render_state(self):
+        # Immutable copy of what drawing reads. Platform objects are shared as
+        # they are never changed once a level is built.
+        return (
+            self.state,
+            self.from_pause,
+            self.level,
+            self.local_player,
+            tuple(self.platforms),
+            (self.door.x, self.door.y) if self.door else None,
+            tuple((enemy.x, enemy.y) for enemy in self.enemies),
+            tuple((coin.x, coin.y, coin.collected) for coin in self.coins),
+            tuple((p.x, p.y, p.health, p.coins, p.facing_right, p.on_ground, p.invincible)
+                  for p in self.players),
+        )
+
+    def show(self, frame):
+        # Load a render_state() frame into this Game, reusing its entities so
+        # their draw-only animation counters keep running
+        (self.state, self.from_pause, self.level, self.local_player, self.platforms,
+         door, enemies, coins, players) = frame
+        if door is None:
+            self.door = None
+        elif self.door is None or (self.door.x, self.door.y) != door:
+            self.door = Door(*door)
+        del self.enemies[len(enemies):]
+        while len(self.enemies) < len(enemies):
+            self.enemies.append(Enemy(0, 0))
+        for enemy, (x, y) in zip(self.enemies, enemies):
+            enemy.x, enemy.y = x, y
+        del self.coins[len(coins):]
+        for i, (x, y, collected) in enumerate(coins):
+            if i == len(self.coins) or (self.coins[i].x, self.coins[i].y) != (x, y):
+                self.coins[i:i + 1] = [Coin(x, y)]
+            self.coins[i].collected = collected
+        del self.players[len(players):]
+        while len(self.players) < len(players):
+            self.add_player()
+        for p, state in zip(self.players, players):
+            p.x, p.y, p.health, p.coins, p.facing_right, p.on_ground, p.invincible = state
+
+
+# --- Rewind ---
+REWIND_MEMORY_CAP = 4 * 1024 * 1024  # bytes of compressed history to keep
+REWIND_KEYFRAME_INTERVAL = 60        # ticks between full keyframes
+RNG_SNAPSHOT_CHUNK = 16              # Mersenne Twister words per snapshot key
+
+
+def _pack(obj):
+    return zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), 1)
+
+
+def _unpack(data):
+    return pickle.loads(zlib.decompress(data))
+
+
+class RewindBuffer:
+    # History is a ring of segments: one compressed keyframe followed by
+    # compressed deltas against that keyframe (never against each other).
+    # Stepping back therefore costs one delta decode plus one restore no matter
+    # how far back we are, which keeps rewinding at full frame rate.
+    def __init__(self, max_bytes=REWIND_MEMORY_CAP, keyframe_interval=REWIND_KEYFRAME_INTERVAL):
+        self.max_bytes = max_bytes
+        self.keyframe_interval = keyframe_interval
+        self.clear()
+
+    def clear(self):
+        self.segments = deque()  # [keyframe_bytes, keyframe_dict_or_None, [delta_bytes, ...]]
+        self.total_bytes = 0
+        self.frames = 0
+
+    def record(self, game):
+        # Keep the RNG so a rewound game spawns exactly what a replay of the
+        # trimmed input log would
+        snap = game.snapshot(include_rng=True)
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or len(segment[2]) + 1 >= self.keyframe_interval:
+            data = _pack(snap)
+            self.segments.append([data, snap, []])
+            # Only the newest segment keeps its keyframe decoded
+            if segment is not None:
+                segment[1] = None
+        else:
+            keyframe = segment[1]
+            changed = {k: v for k, v in snap.items() if k not in keyframe or keyframe[k] != v}
+            removed = tuple(k for k in keyframe if k not in snap)
+            data = _pack((changed, removed))
+            segment[2].append(data)
+        self.total_bytes += len(data)
+        self.frames += 1
+        self._trim()
+
+    def _trim(self):
+        # Drop whole segments from the old end; a delta is useless without its keyframe
+        while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+            data, _, deltas = self.segments.popleft()
+            self.total_bytes -= len(data) + sum(len(d) for d in deltas)
+            self.frames -= 1 + len(deltas)
+
+    def step_back(self, game):
+        # Restore the state before the newest recorded tick and forget it.
+        # Returns False when empty.
+        if not self.segments:
+            return False
+        segment = self.segments[-1]
+        if segment[1] is None:
+            segment[1] = _unpack(segment[0])
+        if segment[2]:
+            data = segment[2].pop()
+            changed, removed = _unpack(data)
+            snap = dict(segment[1])
+            snap.update(changed)
+            for k in removed:
+                del snap[k]
+        else:
+            data = segment[0]
+            snap = segment[1]
+            self.segments.pop()
+        self.total_bytes -= len(data)
+        self.frames -= 1
+        game.restore(snap)
+        return True
+
+    def seconds(self):
+        return self.frames / FPS
+
+    def bytes_per_second(self):
+        if self.frames == 0:
+            return 0
+        return self.total_bytes / self.seconds()
+
+
+# --- Recording & Ghosts ---
+class InputLog:
+    # A run is its seed plus one INPUT_* byte per tick; everything else replays
+    MAGIC = b"ADLG"
+    HEADER = struct.Struct("<4sIHH")
+
+    def __init__(self, seed, size=None):
+        self.seed = seed
+        self.size = size or (WIDTH, HEIGHT)  # layouts depend on the window size
+        self.bits = bytearray()
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.seed, *self.size))
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, seed, w, h = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError(f"{path} is not an input log")
+        log = cls(seed, (w, h))
+        log.bits = bytearray(data[cls.HEADER.size:])
+        return log
+
+
+class Ghost:
+    # Replays a recorded run in its own Game so it never touches the live one
+    def __init__(self, log):
+        self.log = log
+        self.game = Game(log.seed)
+        self.game.state = "playing"
+        self.game.player.color = GHOST_COLOR
+        self.history = RewindBuffer(max_bytes=REWIND_MEMORY_CAP // 4)
+        self.tick = 0
+
+    def step(self):
+        if self.tick < len(self.log.bits):
+            self.history.record(self.game)
+            with quiet():
+                self.game.step([self.log.bits[self.tick]])
+            self.tick += 1
+
+    def step_back(self):
+        # Follow the live game when it rewinds
+        if self.tick > 0 and self.history.step_back(self.game):
+            self.tick -= 1
+
+    def draw(self, level):
+        # Layouts match per level, so only show the ghost on the level being played
+        if self.game.level == level and self.game.state == "playing":
+            self.game.player.draw()
+
+
+# --- Netplay ---
+# A relay runs the tick clock. Clients send their input bits only when they
+# change (tagged with the tick they apply to); every tick the relay broadcasts
+# just the changes. Clients simulate ahead with predicted inputs and roll back
+# to the last confirmed state when a confirmed frame disagrees.
+NET_PORT = 50515
+NET_INPUT_DELAY = 2      # ticks between pressing a key and it applying
+NET_MAX_PREDICTION = 8   # ticks a client may run ahead of the relay
+NET_FAST_FORWARD = 600   # confirmed ticks a late client may catch up per frame
+NET_JOINED = 0x80        # flag in a frame entry: this player id is new
+
+WELCOME = struct.Struct("<cBIHH")  # b"W", player id, seed, window width, height; b"X" if the relay is full
+FRAME = struct.Struct("<cIB")    # b"F", tick, number of changes; then (id, bits) pairs
+INPUT = struct.Struct("<cIB")    # b"I", tick, bits
+CHANGE = struct.Struct("<BB")
+
+
+class LockstepRelay:
+    def __init__(self, seed, size, max_players=4):
+        self.seed = seed
+        self.size = size     # layouts depend on the window size, so every peer uses this one
+        self.max_players = max_players
+        self.writers = []
+        self.bits = []       # held input per player id
+        self.connected = set()
+        self.pending = {}    # tick -> [(player id, bits)]
+        self.joined = []
+        self.history = bytearray()  # every frame so far, replayed to late joiners
+        self.tick = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    async def serve(self, host="127.0.0.1", port=NET_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await self.run_clock()
+
+    async def handle(self, reader, writer):
+        if len(self.connected) >= self.max_players:
+            writer.write(WELCOME.pack(b"X", 0, 0, 0, 0))
+            await writer.drain()
+            writer.close()
+            return
+        # Reuse the lowest id someone left; a rejoining peer takes over that player
+        pid = min(set(range(len(self.bits) + 1)) - self.connected)
+        if pid == len(self.bits):
+            self.bits.append(0)
+        self.connected.add(pid)
+        self.joined.append(pid)
+        hello = WELCOME.pack(b"W", pid, self.seed, *self.size) + bytes(self.history)
+        writer.write(hello)
+        self.bytes_sent += len(hello)
+        self.writers.append(writer)
+        try:
+            while True:
+                data = await reader.readexactly(INPUT.size)
+                self.bytes_received += len(data)
+                _, tick, bits = INPUT.unpack(data)
+                # Inputs that arrive late apply on the next tick; the sender rolls back
+                due = self.pending.setdefault(max(tick, self.tick), {})
+                due[pid] = bits | (due.get(pid, 0) & INPUT_JUMP)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.pending.setdefault(self.tick, {})[pid] = 0
+            self.writers.remove(writer)
+            self.connected.discard(pid)
+
+    async def run_clock(self):
+        loop = asyncio.get_running_loop()
+        while not self.writers:
+            await asyncio.sleep(0.01)
+        start = loop.time()
+        while True:
+            changes = {pid: self.bits[pid] | NET_JOINED for pid in self.joined}
+            self.joined.clear()
+            for pid, bits in self.pending.pop(self.tick, {}).items():
+                if self.bits[pid] != bits or bits & INPUT_JUMP:
+                    changes[pid] = bits | (changes.get(pid, 0) & NET_JOINED)
+                self.bits[pid] = bits
+            frame = FRAME.pack(b"F", self.tick, len(changes)) + b"".join(
+                CHANGE.pack(pid, bits) for pid, bits in changes.items())
+            self.history += frame
+            for writer in self.writers:
+                writer.write(frame)
+                self.bytes_sent += len(frame)
+            # A jump only lasts the tick it was pressed on; both ends clear it
+            self.bits = [bits & ~INPUT_JUMP for bits in self.bits]
+            self.tick += 1
+            await asyncio.sleep(max(0, start + self.tick / FPS - loop.time()))
+
+
+def start_relay(seed, size, port=NET_PORT):
+    relay = LockstepRelay(seed, size)
+    threading.Thread(target=lambda: asyncio.run(relay.serve(port=port)), daemon=True).start()
+    return relay
+
+
+class NetSession:
+    def __init__(self, game, host="127.0.0.1", port=NET_PORT):
+        self.game = game
+        self.frames = queue.Queue()
+        self.player_id = None
+        self.loop = None
+        self.writer = None
+        self.ready = False
+        self.closed = False
+        self.refusal = None        # why the relay never let us in, for the menu
+        self.held = []             # confirmed held bits per player
+        self.confirmed_tick = -1
+        self.confirmed_snap = None
+        self.tick = 0              # next tick to predict
+        self.predicted = deque()   # (tick, inputs, snapshot after the tick)
+        self.local_changes = []    # (tick, bits) sent but not yet confirmed
+        self.last_sent = 0
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = time.perf_counter()
+        threading.Thread(target=lambda: asyncio.run(self.receive(host, port)), daemon=True).start()
+
+    async def receive(self, host, port):
+        for attempt in range(50):
+            try:
+                reader, self.writer = await asyncio.open_connection(host, port)
+                break
+            except OSError:
+                # A relay started in this process may still be binding
+                await asyncio.sleep(0.1)
+        else:
+            self.frames.put(("unreachable", None))
+            return
+        self.loop = asyncio.get_running_loop()
+        try:
+            data = await reader.readexactly(WELCOME.size)
+            kind, self.player_id, seed, w, h = WELCOME.unpack(data)
+            self.bytes_received += len(data)
+            if kind != b"W":
+                self.frames.put(("full", None))
+                return
+            self.frames.put(("welcome", (seed, (w, h))))
+            while True:
+                data = await reader.readexactly(FRAME.size)
+                _, tick, n = FRAME.unpack(data)
+                body = await reader.readexactly(n * CHANGE.size)
+                self.bytes_received += len(data) + len(body)
+                self.frames.put((tick, [CHANGE.unpack_from(body, i * CHANGE.size) for i in range(n)]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.frames.put(("closed", None))
+
+    def send(self, tick, bits):
+        data = INPUT.pack(b"I", tick, bits)
+        self.bytes_sent += len(data)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        if self.loop and not self.closed:
+            self.loop.call_soon_threadsafe(self.writer.close)
+        self.closed = True
+
+    def predicted_inputs(self, tick):
+        inputs = [bits & ~INPUT_JUMP for bits in self.held]
+        if self.player_id < len(inputs):
+            bits = inputs[self.player_id]
+            for t, b in self.local_changes:
+                if t < tick:
+                    bits = b & ~INPUT_JUMP
+                elif t == tick:
+                    bits = b
+            inputs[self.player_id] = bits
+        return inputs
+
+    def apply_confirmed(self, tick, changes):
+        for pid, bits in changes:
+            if bits & NET_JOINED:
+                while len(self.held) <= pid:
+                    self.held.append(0)
+            self.held[pid] = bits & ~NET_JOINED
+        inputs = list(self.held)
+        self.held = [bits & ~INPUT_JUMP for bits in self.held]
+        self.local_changes = [(t, b) for t, b in self.local_changes if t > tick]
+        return inputs
+
+    def advance(self, bits):
+        # Called once per rendered frame while playing
+        global WIDTH, HEIGHT
+        if not self.ready:
+            try:
+                kind, welcome = self.frames.get_nowait()
+            except queue.Empty:
+                return
+            if kind != "welcome":
+                self.refusal = {"full": "The relay is full",
+                                "unreachable": "Could not reach the relay"}.get(kind, "The relay closed the connection")
+                self.closed = True
+                return
+            self.ready = True
+            # Simulate at the relay's size; the main loop resizes the window to match
+            seed, (WIDTH, HEIGHT) = welcome
+            self.game.reset_full(seed)
+            self.game.state = "playing"
+            self.game.local_player = self.player_id
+            self.confirmed_snap = self.game.snapshot(include_rng=True)
+
+        # Schedule our own input a few ticks out so it reaches the relay in time
+        if (bits & ~INPUT_JUMP) != self.last_sent or bits & INPUT_JUMP:
+            target = self.tick + NET_INPUT_DELAY
+            self.send(target, bits)
+            self.local_changes.append((target, bits))
+            self.last_sent = bits & ~INPUT_JUMP
+
+        rolled_back = False
+        caught_up = 0
+        while caught_up < NET_FAST_FORWARD:
+            try:
+                tick, changes = self.frames.get_nowait()
+            except queue.Empty:
+                break
+            if tick == "closed":
+                self.closed = True
+                break
+            caught_up += 1
+            inputs = self.apply_confirmed(tick, changes)
+            if self.predicted and not rolled_back:
+                p_tick, p_inputs, p_snap = self.predicted[0]
+                if p_tick == tick and p_inputs == inputs:
+                    self.predicted.popleft()
+                    self.confirmed_snap = p_snap
+                    self.confirmed_tick = tick
+                    continue
+                # Misprediction: back to the last confirmed state, then replay
+                rolled_back = True
+                self.rollbacks += 1
+                self.game.restore(self.confirmed_snap)
+            self.predicted.clear()
+            with quiet():
+                self.game.step(inputs)
+            self.confirmed_tick = tick
+            self.confirmed_snap = None
+        if self.confirmed_snap is None:
+            self.confirmed_snap = self.game.snapshot(include_rng=True)
+
+        if not self.frames.empty():
+            return  # still fast-forwarding; predicting now would only be thrown away
+
+        # Re-predict the ticks that were thrown away, then one new tick
+        self.tick = max(self.tick, self.confirmed_tick + 1)
+        t = self.confirmed_tick + 1 + len(self.predicted)
+        while t <= self.tick and len(self.predicted) < NET_MAX_PREDICTION:
+            inputs = self.predicted_inputs(t)
+            if t < self.tick:
+                self.resimulated += 1
+                with quiet():
+                    self.game.step(inputs)
+            else:
+                self.game.step(inputs)
+            self.predicted.append((t, inputs, self.game.snapshot(include_rng=True)))
+            t += 1
+        self.tick = t
+
+    def bytes_per_second(self):
+        return (self.bytes_sent + self.bytes_received) / max(time.perf_counter() - self.started, 1e-6)
+
+    def report_lines(self):
+        return [f"netplay: player {self.player_id}, tick {self.confirmed_tick}, "
+                f"{self.bytes_per_second() / 1024:.2f} KB/s, "
+                f"{self.rollbacks} rollbacks, {self.resimulated} resimulated ticks"]
+
+
+# --- Scores ---
+SCORES_DB = "scores.db"
+SCORES_MAX_ATTEMPTS = 3  # batches a run is retried with before it is dropped
+
+SCORES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    ticks INTEGER NOT NULL,
+    health INTEGER NOT NULL,
+    players INTEGER NOT NULL,
+    seed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_score ON runs (score DESC, finished_at);
+CREATE INDEX IF NOT EXISTS runs_by_level ON runs (level, score DESC);
+"""
+
+
+class ScoreStore:
+    # All disk I/O happens on one background thread. Writes are queued and
+    # committed in batches; reads go through the same queue so they see every
+    # run recorded before them, and come back as Futures the UI can poll.
+    def __init__(self, path=SCORES_DB, batch_size=500, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def record_run(self, game, outcome):
+        player = game.players[game.local_player]
+        self.jobs.put(("run", (time.time(), outcome, player.coins, game.level, game.ticks,
+                               max(0, player.health), len(game.players), game.seed)))
+
+    def top(self, n=10, level=None):
+        future = Future()
+        self.jobs.put(("top", (n, level), future))
+        return future
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join(timeout=5)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        # WAL lets readers (other game instances, reporting scripts) run alongside the writer
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCORES_SCHEMA)
+        return conn
+
+    def _run(self):
+        # A failing database (locked, full disk, unreadable file) must never take
+        # the thread down: the batch is logged, its rows are retried with the
+        # next batch, and waiting reads get the error instead of hanging
+        conn = None
+        unsaved = []  # rows from failed batches
+        attempts = 0
+        running = True
+        while running:
+            jobs = [self.jobs.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Keep batching writes until the batch is full, the interval is up,
+            # or someone is waiting on a read
+            while len(jobs) < self.batch_size and jobs[-1] and jobs[-1][0] == "run":
+                try:
+                    jobs.append(self.jobs.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            rows = unsaved + [job[1] for job in jobs if job and job[0] == "run"]
+            error = None
+            try:
+                if conn is None:
+                    conn = self._connect()
+                if rows:
+                    with conn:
+                        conn.executemany("INSERT INTO runs (finished_at, outcome, score, level, ticks, health, "
+                                         "players, seed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                unsaved, attempts = [], 0
+            except sqlite3.Error as e:
+                error = e
+                attempts += 1
+                if attempts < SCORES_MAX_ATTEMPTS:
+                    unsaved = rows
+                    print(f"scores: could not save {len(rows)} runs, will retry: {e}")
+                else:
+                    unsaved, attempts = [], 0
+                    print(f"scores: dropping {len(rows)} runs after {SCORES_MAX_ATTEMPTS} attempts: {e}")
+                if conn is not None:
+                    conn.close()
+                    conn = None  # reconnect next batch
+            for job in jobs:
+                if job is None:
+                    running = False
+                elif job[0] == "top":
+                    (n, level), future = job[1], job[2]
+                    try:
+                        if error:
+                            raise error
+                        future.set_result(self._top(conn, n, level))
+                    except sqlite3.Error as e:
+                        future.set_exception(e)
+        if conn is not None:
+            conn.close()
+
+    @staticmethod
+    def _top(conn, n, level):
+        if level is None:
+            cursor = conn.execute("SELECT score, level, outcome, ticks FROM runs "
+                                  "ORDER BY score DESC, finished_at LIMIT ?", (n,))
+        else:
+            cursor = conn.execute("SELECT score, level, outcome, ticks FROM runs WHERE level = ? "
+                                  "ORDER BY score DESC LIMIT ?", (level, n))
+        return cursor.fetchall()
+
 
 # --- Instantiate game ---
+particles = ParticleSystem()
+quality = QualityGovernor()
 game = Game()
+rewind = RewindBuffer()
+scores = None  # opened by main() for interactive play only
+leaderboard = None
 
 
 # --- Menu Actions ---
 def start_game():
-    game.reset_full()
+    global ghost, input_log, net_notice
+    net_notice = None
+    game.reset_full(ghost_log.seed if ghost_log else None)
+    rewind.clear()
+    particles.clear()
+    ghost = Ghost(ghost_log) if ghost_log else None
+    input_log = InputLog(game.seed)
     game.state = "playing"
 
 
@@ -707,19 +2026,56 @@ def open_instructions():
 
 
 def quit_game():
+    save_recording()
+    if scores:
+        scores.close()
+    for line in latency.report_lines() + (session.report_lines() if session else []):
+        print(line)
     pygame.quit()
     sys.exit()
 
 
 def back_to_menu():
-    if monster_sound:
-        monster_sound.stop()
+    stop_sound(monster_sound)
+    if session:
+        session.close()
     game.from_pause = True
     game.state = "main_menu"
 
 
-# --- Buttons ---
-def create_main_menu_buttons():
+def close_instructions():
+    game.state = "main_menu"
+
+
+def save_recording():
+    if args.record and input_log and input_log.bits:
+        input_log.save(args.record)
+
+
+def finish_run():
+    global leaderboard
+    save_recording()
+    if scores:
+        scores.record_run(game, game.state)
+        leaderboard = scores.top(5)
+
+
+# --- Screens ---
+_ui_cache = {}
+AMBIENT_INTERVAL = 50  # ms between frames of the sparkle and glow effects on menu screens
+
+
+def get_ui(name, key, build):
+    # One retained screen per name, rebuilt only when the window size or key changes
+    cache_key = (WIDTH, HEIGHT, key)
+    entry = _ui_cache.get(name)
+    if entry is None or entry[0] != cache_key:
+        entry = (cache_key, build())
+        _ui_cache[name] = entry
+    return entry[1]
+
+
+def build_main_menu_ui():
     w, h = 240, 54
     cx = WIDTH // 2 - w // 2
     start_y = HEIGHT // 2 - 100
@@ -734,196 +2090,722 @@ def create_main_menu_buttons():
         Button("Instructions", (cx, start_y + 70, w, h), GREY, BLUE, open_instructions),
         Button("Quit", (cx, start_y + 140, w, h), GREY, RED, quit_game),
     ]
-    return buttons
-
+    if net_notice:
+        buttons.append(Label(net_notice, (WIDTH//2, start_y + 210), color=RED, anchor="midtop"))
 
-def create_in_game_menu_button():
-    return Button("Menu", (20, HEIGHT - 60, 120, 36), GREY, GREEN, back_to_menu)
+    # Sample gameplay in background
+    sample_platform = Platform(WIDTH//2 - 100, HEIGHT//2 - 300, 200)
+    sample_door = Door(WIDTH//2 - 15, HEIGHT//2 - 360)
+    sample_clock = TickClock()
 
+    def draw_samples():
+        sample_platform.draw()
+        sample_door.draw(sample_clock.elapsed())
+        particles.draw(screen)
 
-# --- Main Loop ---
-clock = pygame.time.Clock()
-
-while True:
-    clicked = None
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            quit_game()
-        if event.type == pygame.VIDEORESIZE:
-            WIDTH, HEIGHT = event.w, event.h
-            screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
-            game.generate_level()
-        if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                if game.state == "playing":
-                    back_to_menu()
-                elif game.state in ["game_over", "victory"]:
-                    back_to_menu()
-            if event.key == pygame.K_SPACE and game.state == "playing":
-                game.player.jump()
-            if event.key == pygame.K_r and game.state == "game_over":
-                start_game()
-            if event.key == pygame.K_RETURN and game.state == "victory":
-                back_to_menu()
-        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-            clicked = event.pos
-
-    # Movement
-    keys = pygame.key.get_pressed()
-    if game.state == "playing":
-        if keys[pygame.K_LEFT] or keys[pygame.K_a]:
-            game.player.x -= game.player.speed
-            game.player.facing_right = False
-        if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
-            game.player.x += game.player.speed
-            game.player.facing_right = True
+    return UIScreen([
+        LiveWidget(game.draw_background, interval=80),  # clouds move a pixel every 80 ms
+        GlowLabel("Hero Adventure", (WIDTH//2, HEIGHT//2 - 200), title_font, YELLOW),
+        Label("University Project", (WIDTH//2, HEIGHT//2 - 150), anchor="midtop"),
+        LiveWidget(draw_samples, AMBIENT_INTERVAL),
+    ] + buttons)
 
-    game.update()
 
-    # --- Draw ---
-    if game.state == "main_menu":
-        game.draw_background()
-        
-        # Title with glow effect
-        for offset in range(3, 0, -1):
-            title = title_font.render("Hero Adventure", True, (255//offset, 255//offset, 0))
-            screen.blit(title, (WIDTH//2 - title.get_width()//2 + offset, 
-                              HEIGHT//2 - 200 + offset))
-        title = title_font.render("Hero Adventure", True, YELLOW)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, HEIGHT//2 - 200))
-        
-        subtitle = font.render("University Project", True, WHITE)
-        screen.blit(subtitle, (WIDTH//2 - subtitle.get_width()//2, HEIGHT//2 - 150))
-        
-        # Draw sample gameplay in background
-        if len(game.platforms) > 0:
-            sample_platform = Platform(WIDTH//2 - 100, HEIGHT//2 - 300, 200)
-            sample_platform.draw()
-            sample_door = Door(WIDTH//2 - 15, HEIGHT//2 - 360)
-            sample_door.draw()
-        
-        buttons = create_main_menu_buttons()
-        for b in buttons:
-            b.draw()
-        if clicked:
-            for b in buttons:
-                if b.clicked(clicked):
-                    b.action()
-
-    elif game.state == "instructions":
-        screen.fill((20, 20, 40))
-        
+def build_instructions_ui():
+    widgets = [
         # Decorative border
-        pygame.draw.rect(screen, (50, 50, 80), (50, 50, WIDTH-100, HEIGHT-100), border_radius=10)
-        pygame.draw.rect(screen, (80, 80, 120), (50, 50, WIDTH-100, HEIGHT-100), 3, border_radius=10)
-        
-        title = title_font.render("How to Play", True, YELLOW)
-        screen.blit(title, (WIDTH//2 - title.get_width()//2, 80))
-        
-        sections = [
-            ("CONTROLS", [
-                "← → or A D : Move Left/Right",
-                "SPACE : Jump (Press again for double jump!)",
-                "ESC : Pause Game / Return to Menu"
-            ]),
-            ("OBJECTIVE", [
-                "• Collect golden coins for points",
-                "• Avoid red enemies (they damage you!)",
-                "• Reach the magical door to advance",
-                f"• Complete all {game.max_levels} levels to win!"
-            ]),
-            ("FEATURES", [
-                "• Double jump in mid-air",
-                "• Health regenerates between levels",
-                "• Enemies get faster each level",
-                "• Bonus coins for completing levels"
-            ])
-        ]
-        
-        y_offset = 150
-        for section_title, lines in sections:
-            section_title_text = font.render(section_title, True, (100, 200, 255))
-            screen.blit(section_title_text, (WIDTH//2 - section_title_text.get_width()//2, y_offset))
-            y_offset += 40
-            
-            for line in lines:
-                line_text = font.render(line, True, WHITE)
-                screen.blit(line_text, (100, y_offset))
-                y_offset += 30
-            y_offset += 20
-        
-        back_btn = Button("Back to Menu", (WIDTH//2 - 110, HEIGHT - 100, 220, 50), 
-                         (80, 80, 120), (100, 150, 255), back_to_menu)
-        back_btn.draw()
-        if clicked and back_btn.clicked(clicked):
-            game.state = "main_menu"
-
-    elif game.state == "playing":
-        game.draw_background()
-        game.draw_platforms()
-        if game.door:
-            game.door.draw()
-        for coin in game.coins:
-            coin.draw()
-        for enemy in game.enemies:
-            enemy.draw()
-        game.player.draw()
-        game.draw_ui()
-        btn = create_in_game_menu_button()
-        btn.draw()
-        if clicked and btn.clicked(clicked):
-            btn.action()
-
-    elif game.state == "game_over":
-        screen.fill((20, 0, 0))
-        
-        # Game over text with effect
-        game_over_text = title_font.render("GAME OVER", True, RED)
-        text_rect = game_over_text.get_rect(center=(WIDTH//2, HEIGHT//2 - 60))
-        
-        # Glow effect
-        for i in range(10, 0, -1):
-            glow_text = title_font.render("GAME OVER", True, (255//i, 0, 0))
-            glow_rect = glow_text.get_rect(center=(WIDTH//2 + random.randint(-3, 3), 
+        Panel((50, 50, WIDTH-100, HEIGHT-100), (50, 50, 80), (80, 80, 120)),
+        Label("How to Play", (WIDTH//2, 80), title_font, YELLOW, anchor="midtop"),
+    ]
+
+    sections = [
+        ("CONTROLS", [
+            "← → or A D : Move Left/Right",
+            "SPACE : Jump (Press again for double jump!)",
+            "BACKSPACE : Hold to rewind time",
+            "ESC : Pause Game / Return to Menu"
+        ]),
+        ("OBJECTIVE", [
+            "• Collect golden coins for points",
+            "• Avoid red enemies (they damage you!)",
+            "• Reach the magical door to advance",
+            f"• Complete all {game.max_levels} levels to win!"
+        ]),
+        ("FEATURES", [
+            "• Double jump in mid-air",
+            "• Health regenerates between levels",
+            "• Enemies get faster each level",
+            "• Bonus coins for completing levels"
+        ])
+    ]
+
+    y_offset = 150
+    for section_title, lines in sections:
+        widgets.append(Label(section_title, (WIDTH//2, y_offset), color=(100, 200, 255), anchor="midtop"))
+        y_offset += 40
+
+        for line in lines:
+            widgets.append(Label(line, (100, y_offset)))
+            y_offset += 30
+        y_offset += 20
+
+    widgets.append(Button("Back to Menu", (WIDTH//2 - 110, HEIGHT - 100, 220, 50),
+                          (80, 80, 120), (100, 150, 255), close_instructions))
+    return UIScreen(widgets, fill=(20, 20, 40))
+
+
+def build_hud_ui():
+    controls = [
+        "← →: Move",
+        "SPACE: Jump",
+        "BACKSPACE: Rewind",
+        "ESC: Menu"
+    ]
+    # Stacked above the Menu button
+    widgets = [Label(control, (10, HEIGHT - 70 - (len(controls) - i) * 25), color=(200, 200, 200))
+               for i, control in enumerate(controls)]
+    health = Label("", (220, 10))
+    coins = Label("", (WIDTH - 150, 10))
+    level = Label("", (WIDTH // 2, 10), anchor="midtop")
+    widgets += [
+        health,
+        Label("🪙", (WIDTH - 180, 12), color=YELLOW),
+        coins,
+        level,
+        Button("Menu", (20, HEIGHT - 60, 120, 36), GREY, GREEN, back_to_menu),
+    ]
+    return UIScreen(widgets, health=health, coins=coins, level=level)
+
+
+def leaderboard_widgets(top):
+    if leaderboard is None or not leaderboard.done() or leaderboard.exception():
+        return []
+    widgets = [Label("Best Runs", (WIDTH//2, top), color=(100, 200, 255), anchor="midtop")]
+    for i, (score, level, outcome, ticks) in enumerate(leaderboard.result()):
+        line = f"{i + 1}. {score} coins  -  level {level}  -  {ticks / FPS:.0f}s"
+        widgets.append(Label(line, (WIDTH//2, top + 28 + i * 24), color=(200, 200, 200), anchor="midtop"))
+    return widgets
+
+
+def build_game_over_ui():
+    # Glow layers are rendered once; only their jitter changes per frame
+    glow_layers = [title_font.render("GAME OVER", True, (255//i, 0, 0)) for i in range(10, 0, -1)]
+
+    def draw_glow():
+        for glow_text in glow_layers:
+            glow_rect = glow_text.get_rect(center=(WIDTH//2 + random.randint(-3, 3),
                                                   HEIGHT//2 - 60 + random.randint(-3, 3)))
             screen.blit(glow_text, glow_rect)
-        
-        screen.blit(game_over_text, text_rect)
-        
-        stats = [
-            f"Final Score: {game.player.coins} coins",
-            f"Level Reached: {game.level}",
-            f"Enemies Defeated: {game.player.coins // 10}"
-        ]
-        
-        for i, stat in enumerate(stats):
-            stat_text = font.render(stat, True, YELLOW)
-            screen.blit(stat_text, (WIDTH//2 - stat_text.get_width()//2, HEIGHT//2 + i * 30))
-        
-        instructions = font.render("Press R to Restart or ESC for Menu", True, WHITE)
-        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT//2 + 120))
 
-    elif game.state == "victory":
-        screen.fill((0, 20, 0))
-        
-        # Victory text with sparkle effect
-        victory_text = title_font.render("VICTORY!", True, YELLOW)
-        screen.blit(victory_text, (WIDTH//2 - victory_text.get_width()//2, HEIGHT//2 - 80))
-        
-        congrats = font.render(f"Congratulations! You completed all {game.max_levels} levels!", True, WHITE)
-        screen.blit(congrats, (WIDTH//2 - congrats.get_width()//2, HEIGHT//2))
-        
-        final_score = font.render(f"Final Score: {game.player.coins} coins", True, (255, 215, 0))
-        screen.blit(final_score, (WIDTH//2 - final_score.get_width()//2, HEIGHT//2 + 40))
-        
-        # Sparkle effect
-        for _ in range(10):
-            sparkle_x = random.randint(WIDTH//2 - 200, WIDTH//2 + 200)
-            sparkle_y = random.randint(HEIGHT//2 - 100, HEIGHT//2 + 100)
-            pygame.draw.circle(screen, (255, 255, 200), (sparkle_x, sparkle_y), random.randint(2, 5))
-        
-        instructions = font.render("Press ENTER to return to Menu", True, (200, 255, 200))
-        screen.blit(instructions, (WIDTH//2 - instructions.get_width()//2, HEIGHT//2 + 100))
+    stats = [
+        f"Final Score: {game.player.coins} coins",
+        f"Level Reached: {game.level}",
+        f"Enemies Defeated: {game.player.coins // 10}"
+    ]
+    return UIScreen(leaderboard_widgets(HEIGHT//2 + 160) + [
+        LiveWidget(draw_glow, AMBIENT_INTERVAL, effect="glow"),
+        Label("GAME OVER", (WIDTH//2, HEIGHT//2 - 60), title_font, RED, anchor="center"),
+    ] + [
+        Label(stat, (WIDTH//2, HEIGHT//2 + i * 30), color=YELLOW, anchor="midtop")
+        for i, stat in enumerate(stats)
+    ] + [
+        Label("Press R to Restart or ESC for Menu", (WIDTH//2, HEIGHT//2 + 120), anchor="midtop"),
+    ], fill=(20, 0, 0))
+
+
+def build_victory_ui():
+    sparkle_clock = TickClock()
+
+    def draw_sparkles():
+        particles.emit(WIDTH//2 - 200, HEIGHT//2 - 100, 10 * sparkle_clock.elapsed(), area=(400, 200), speed=0.5,
+                       life=(10, 40), colors=VICTORY_COLORS)
+        particles.draw(screen)
+
+    return UIScreen(leaderboard_widgets(HEIGHT//2 + 140) + [
+        Label("VICTORY!", (WIDTH//2, HEIGHT//2 - 80), title_font, YELLOW, anchor="midtop"),
+        Label(f"Congratulations! You completed all {game.max_levels} levels!", (WIDTH//2, HEIGHT//2),
+              anchor="midtop"),
+        Label(f"Final Score: {game.player.coins} coins", (WIDTH//2, HEIGHT//2 + 40), color=(255, 215, 0),
+              anchor="midtop"),
+        LiveWidget(draw_sparkles, AMBIENT_INTERVAL),
+        Label("Press ENTER to return to Menu", (WIDTH//2, HEIGHT//2 + 100), color=(200, 255, 200),
+              anchor="midtop"),
+    ], fill=(0, 20, 0))
+
+
+# --- Input ---
+# Everything else (mouse motion during play, text input, window focus, ...) is
+# dropped by SDL before it reaches the queue. Held keys still come from key.get_pressed().
+HANDLED_EVENTS = [pygame.QUIT, pygame.VIDEORESIZE, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN]
+pygame.event.set_blocked(None)
+pygame.event.set_allowed(HANDLED_EVENTS)
+
+MOVE_KEYS = (pygame.K_LEFT, pygame.K_a, pygame.K_RIGHT, pygame.K_d)
+
+# Menu and end screens sleep in pump_input until something happens. There they
+# also need mouse motion (hover) and expose events (a window uncovered), which
+# are not worth queueing during play.
+IDLE_EVENTS = [pygame.MOUSEMOTION, pygame.WINDOWEXPOSED]
+IDLE_MAX_WAIT = 250  # ms; also how quickly an idle screen notices outside changes (leaderboard)
+
+
+def allow_idle_events(allow):
+    if allow:
+        pygame.event.set_allowed(IDLE_EVENTS)
+    else:
+        pygame.event.set_blocked(IDLE_EVENTS)
+
+
+def pump_input(timeout=0):
+    # Drain the queue and stamp every event with the time it reached us. With
+    # a timeout (ms), first sleep until an event arrives or it runs out.
+    events = []
+    if timeout > 0:
+        event = pygame.event.wait(timeout)
+        if event.type != pygame.NOEVENT:
+            events.append(event)
+    events += pygame.event.get()
+    now = time.perf_counter()
+    return [(now, event) for event in events]
+
+
+class LatencyTracker:
+    # Input-to-present latency: from the pump that delivered a key press to the
+    # end of the first flip() that shows its effect. Time the event spent queued
+    # before that pump is not visible to pygame and is not included.
+    # Inputs handed to the simulation are numbered, so a press only counts as
+    # shown once a frame simulated from its input (or a later one) is flipped.
+    def __init__(self, history=1000):
+        self.samples = {"jump": deque(maxlen=history), "move": deque(maxlen=history)}
+        self.pending = {}  # kind -> (event_time, number of the input carrying it)
+        self.inputs = 0
+
+    def mark(self, kind, event_time):
+        # Keep the oldest unpresented press; that is the one the player is waiting on.
+        # It goes out with the next input.
+        self.pending.setdefault(kind, (event_time, self.inputs + 1))
+
+    def next_input(self):
+        self.inputs += 1
+        return self.inputs
+
+    def presented(self, present_time, input_number):
+        # input_number is the newest input the flipped frame was simulated from
+        for kind in [kind for kind, (_, number) in self.pending.items() if number <= input_number]:
+            event_time, _ = self.pending.pop(kind)
+            self.samples[kind].append(present_time - event_time)
+
+    def stats(self, kind):
+        values = sorted(self.samples[kind])
+        if not values:
+            return None
+
+        def pick(q):
+            return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+        return {
+            "count": len(values),
+            "mean": sum(values) / len(values) * 1000,
+            "p50": pick(0.50),
+            "p95": pick(0.95),
+            "p99": pick(0.99),
+            "max": values[-1] * 1000,
+        }
+
+    def report_lines(self):
+        lines = []
+        for kind in self.samples:
+            st = self.stats(kind)
+            if st:
+                lines.append(f"{kind} latency (ms, n={st['count']}): mean {st['mean']:.1f}  p50 {st['p50']:.1f}  "
+                             f"p95 {st['p95']:.1f}  p99 {st['p99']:.1f}  max {st['max']:.1f}")
+        return lines
+
+
+latency = LatencyTracker()
+show_latency = False
+
+
+# --- Simulation ---
+def simulate(bits, rewinding):
+    # One tick of the live game, run by the main loop or by SimThread
+    was_playing = game.state == "playing"
+    if rewinding:
+        # Hold to run time backwards; the game stays paused once history runs out
+        if rewind.step_back(game):
+            if input_log and input_log.bits:
+                input_log.bits.pop()
+            if ghost:
+                ghost.step_back()
+    elif session and game.state == "playing":
+        session.advance(bits)
+    else:
+        if was_playing:
+            # History holds the state before each played tick, so a step back
+            # undoes exactly one tick along with its input byte
+            rewind.record(game)
+        game.step([bits])
+        if was_playing:
+            if input_log is not None:
+                input_log.bits.append(bits)
+            if ghost:
+                ghost.step()
+    if was_playing and game.state in ("game_over", "victory"):
+        finish_run()
+
+
+class SimThread:
+    # Ticks the game on a worker thread at FPS. After every tick it publishes
+    # an immutable frame into the back slot of a double buffer and flips it;
+    # the main thread draws the front frame onto its own proxy Game, so it
+    # never sees entities mid-update. Anything the main thread does to the
+    # game (menu actions, resizes) must hold self.lock.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.input_lock = threading.Lock()
+        self.held = 0
+        self.pressed = 0  # edge bits latched until the next tick reads them
+        self.rewinding = False
+        self.input_number = 0  # latency number of the newest input handed over
+        self.shown_input = 0   # ...and of the input behind the frame last presented
+        self.effects = queue.SimpleQueue()
+        self.frames = [None, None]
+        self.front = 0
+        self.view = Game(game.seed)
+        self.ghost_view = Player(GHOST_COLOR)
+        self.ghost_visible = False
+        self.publish()
+        self.thread = threading.Thread(target=self._run, name="simulation", daemon=True)
+        self.thread.start()
+
+    def set_input(self, bits, rewinding, input_number):
+        with self.input_lock:
+            self.held = bits & ~INPUT_JUMP
+            self.pressed |= bits & INPUT_JUMP
+            self.rewinding = rewinding
+            self.input_number = input_number
+
+    def publish(self, input_number=0):
+        ghost_state = None
+        if ghost and ghost.game.level == game.level and ghost.game.state == "playing":
+            p = ghost.game.player
+            ghost_state = (p.x, p.y, p.facing_right, p.on_ground, p.invincible)
+        back = 1 - self.front
+        self.frames[back] = (game.render_state(), ghost_state, input_number)
+        self.front = back
+
+    def _run(self):
+        next_tick = time.perf_counter()
+        while True:
+            with self.input_lock:
+                bits = self.held | self.pressed
+                self.pressed = 0
+                rewinding = self.rewinding
+                input_number = self.input_number
+            with self.lock, deferred(self.effects):
+                simulate(bits, rewinding)
+                self.publish(input_number)
+            next_tick += 1 / FPS
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.25:
+                next_tick = time.perf_counter()  # too far behind to catch up, drop the backlog
+
+    def present(self):
+        # Run the sounds and bursts the simulation queued, then load the newest frame
+        while True:
+            try:
+                effect, effect_args = self.effects.get_nowait()
+            except queue.Empty:
+                break
+            effect(*effect_args)
+        frame, ghost_state, self.shown_input = self.frames[self.front]
+        self.view.show(frame)
+        self.ghost_visible = ghost_state is not None
+        if self.ghost_visible:
+            p = self.ghost_view
+            p.x, p.y, p.facing_right, p.on_ground, p.invincible = ghost_state
+        return self.view
+
+    def draw_ghost(self):
+        if self.ghost_visible:
+            self.ghost_view.draw()
+
+
+# --- Allocation budget ---
+# Transient Python allocation allowed per simulated and drawn tick. Anything
+# above this turns into garbage collector work during play.
+ALLOC_BUDGET_PER_TICK = 2048  # bytes for a full frame; reaching the screen's pixels alone takes about 700
+ALLOC_CHECK_TICKS = 600
+
+
+def check_allocations(ticks=ALLOC_CHECK_TICKS):
+    # Returns the per-tick peak allocation of every measured tick, sorted.
+    # Each tick is a full playing frame: simulation with its sounds and
+    # particle bursts, then background, world, particles and HUD.
+    sim = Game(seed=1)
+    sim.state = "playing"
+    inputs = [0]
+    pattern = (INPUT_RIGHT, INPUT_RIGHT | INPUT_JUMP, INPUT_LEFT, 0)
+    peaks = []
+
+    def frame(tick):
+        # Walk into a coin and an enemy now and then so pickups and hits burst,
+        # and never die so every frame is a playing one
+        player = sim.player
+        player.health = 100
+        if tick % 40 == 0:
+            for coin in sim.coins:
+                if not coin.collected:
+                    coin.x, coin.y = player.x, player.y
+                    coin.rect.update(coin.x, coin.y, coin.size, coin.size)
+                    break
+        if tick % 150 == 0 and sim.enemies:
+            sim.enemies[0].x, sim.enemies[0].y = player.x, player.y
+        sim.step(inputs)
+        particles.update()
+        sim.draw_world(tick * 1000 // FPS)
+        sim.draw_players()
+        particles.draw(screen)
+        sim.draw_ui()
+
+    # Warm up so enemies exist and glow surfaces, HUD text and sounds are cached
+    for tick in range(300):
+        inputs[0] = pattern[tick // 30 % 4]
+        frame(tick)
+    tracemalloc.start()
+    for tick in range(300, 300 + ticks):
+        inputs[0] = pattern[tick // 30 % 4]
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        frame(tick)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    particles.clear()
+    return sorted(peaks)
+
+
+def run_allocation_check():
+    peaks = check_allocations()
+    # Every tick counts, spawns and level builds included
+    print(f"allocation per tick: median {peaks[len(peaks) // 2]} B, p95 {peaks[int(len(peaks) * 0.95)]} B, "
+          f"max {peaks[-1]} B (budget {ALLOC_BUDGET_PER_TICK} B)")
+    return 0 if peaks[-1] <= ALLOC_BUDGET_PER_TICK else 1
+
+
+# --- Replay rendering ---
+REPLAY_PREROLL = 60     # ticks each range re-runs unsaved first, so particles are already alive
+REPLAY_MIN_RANGE = 300  # frames; shorter ranges spend too much on preroll
+
+
+def render_replay(log, out, jobs=None):
+    # Turns a recorded run into frame i = the scene after tick i, either as
+    # numbered PNGs in the directory out or as raw RGB24 video if out ends in
+    # .rgb. The run is simulated once here, keeping a snapshot at the start of
+    # every range; worker processes restore one each and draw their range.
+    global WIDTH, HEIGHT
+    WIDTH, HEIGHT = log.size
+    jobs = jobs or os.cpu_count() or 1
+    total = len(log.bits)
+    if not total:
+        print("the recording has no ticks to render")
+        return 1
+    size = max(REPLAY_MIN_RANGE, math.ceil(total / (jobs * 2)))
+    ranges = [(start, min(start + size, total)) for start in range(0, total, size)]
+    starts = {max(0, start - REPLAY_PREROLL) for start, end in ranges}
+
+    started = time.perf_counter()
+    sim = Game(log.seed)
+    sim.state = "playing"
+    snapshots = {}
+    with quiet():
+        for tick, bits in enumerate(log.bits):
+            if tick in starts:
+                snapshots[tick] = sim.snapshot(include_rng=True)
+            sim.step([bits])
+
+    if out.endswith(".rgb"):
+        with open(out, "wb") as f:
+            f.truncate(total * WIDTH * HEIGHT * 3)
+    else:
+        os.makedirs(out, exist_ok=True)
+    tasks = [(log.seed, log.size, snapshots[max(0, start - REPLAY_PREROLL)], max(0, start - REPLAY_PREROLL),
+              start, bytes(log.bits[max(0, start - REPLAY_PREROLL):end]), out) for start, end in ranges]
+
+    # Spawned workers import this file fresh with the dummy drivers picked at
+    # startup and render to their own off-screen surface
+    pool = multiprocessing.get_context("spawn").Pool(min(jobs, len(tasks)))
+    try:
+        frames = sum(pool.imap_unordered(render_range, tasks))
+    finally:
+        # SDL turns SIGTERM into a quit event, so let workers exit on their own
+        # instead of Pool.terminate()
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - started
+    print(f"rendered {frames} frames ({frames / FPS:.1f}s of play) in {elapsed:.1f}s with {jobs} processes "
+          f"-> {out}")
+    if out.endswith(".rgb"):
+        print(f"play with: ffplay -f rawvideo -pixel_format rgb24 -video_size {WIDTH}x{HEIGHT} "
+              f"-framerate {FPS} {out}")
+    return 0
+
+
+def set_animation_clock(game, tick):
+    # Draw-only counters normally count frames drawn since an entity appeared;
+    # tying them to the tick makes a frame look the same whichever worker draws it
+    for entity in game.players + game.enemies:
+        entity.animation_frame = tick
+    for coin in game.coins:
+        coin.animation_time = tick
+    if game.door:
+        game.door.animation_frame = tick
+
+
+def render_range(task):
+    # Worker: restore the snapshot taken before tick first, re-simulate from
+    # there and save a frame for every tick from start on
+    global WIDTH, HEIGHT, screen
+    seed, size, snap, first, start, bits, out = task
+    WIDTH, HEIGHT = size
+    screen = pygame.Surface(size)
+    frame_bytes = WIDTH * HEIGHT * 3
+    video = open(out, "r+b") if out.endswith(".rgb") else None
+    sim = Game(seed)
+    sim.restore(snap)
+    particles.clear()
+    # Effects draw from their own randomness; seed it so a re-render is identical
+    random.seed(first)
+    particles.rng = np.random.default_rng(first)
+    for offset, tick_bits in enumerate(bits):
+        tick = first + offset
+        sim.step([tick_bits])
+        particles.update()
+        if tick < start - REPLAY_PREROLL // 2:
+            continue  # the first half of the preroll only needs to simulate
+        set_animation_clock(sim, tick)
+        sim.draw_world(now=(tick + 1) * 1000 // FPS)
+        sim.draw_players()
+        particles.draw(screen)
+        sim.draw_ui()
+        if tick < start:
+            continue
+        if video:
+            video.seek(tick * frame_bytes)
+            video.write(pygame.image.tobytes(screen, "RGB"))
+        else:
+            pygame.image.save(screen, os.path.join(out, f"frame_{tick:06d}.png"))
+    if video:
+        video.close()
+    return len(bits) - (start - first)
+
+
+# --- Command line ---
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hero Adventure")
+    parser.add_argument("--host", action="store_true", help="run a local relay and play on it")
+    parser.add_argument("--join", metavar="HOST[:PORT]", help="join a relay started with --host")
+    parser.add_argument("--port", type=int, default=NET_PORT, help="relay port for --host")
+    parser.add_argument("--ghost", metavar="FILE", help="race against a run saved with --record")
+    parser.add_argument("--record", metavar="FILE", help="save the inputs of the last run to FILE")
+    parser.add_argument("--render", metavar="FILE", help="render a run saved with --record to video frames and exit")
+    parser.add_argument("--out", default="frames",
+                        help="with --render: a directory for numbered PNGs, or a .rgb file for raw RGB24 video")
+    parser.add_argument("--jobs", type=int, help="with --render: worker processes (default: one per CPU)")
+    parser.add_argument("--threaded", action="store_true",
+                        help="run the simulation on its own thread, separate from rendering")
+    parser.add_argument("--alloc-check", action="store_true",
+                        help="simulate a level under tracemalloc and fail if ticks exceed the allocation budget")
+    parsed = parser.parse_args()
+    if parsed.threaded and (parsed.host or parsed.join):
+        parser.error("--threaded cannot be combined with --host or --join")
+    return parsed
+
+
+# Set up by main() from the command line
+args = None
+ghost_log = None
+ghost = None
+input_log = None
+session = None
+net_notice = None  # shown on the main menu when joining a relay failed
+sim = None
+sim_lock = nullcontext()
+
 
-    pygame.display.flip()
-    clock.tick(60)
\ No newline at end of file
+# --- Main Loop ---
+def main():
+    global WIDTH, HEIGHT, screen, args, ghost_log, session, sim, sim_lock, show_latency, scores, net_notice
+    args = parse_args()
+    if args.alloc_check:
+        sys.exit(run_allocation_check())
+    if args.render:
+        sys.exit(render_replay(InputLog.load(args.render), args.out, args.jobs))
+    scores = ScoreStore()
+    ghost_log = InputLog.load(args.ghost) if args.ghost else None
+    if args.host:
+        start_relay(random.randrange(2**31), (WIDTH, HEIGHT), args.port)
+        session = NetSession(game, "127.0.0.1", args.port)
+    elif args.join:
+        join_host, _, join_port = args.join.partition(":")
+        session = NetSession(game, join_host, int(join_port or NET_PORT))
+    if session:
+        game.state = "playing"
+    sim = SimThread() if args.threaded else None
+    sim_lock = sim.lock if sim else nullcontext()
+
+    clock = pygame.time.Clock()
+    shown_ui = None  # the menu screen on display, if any
+    idle_wait = 0
+    particle_clock = TickClock()
+
+    while True:
+        clicked = None
+        exposed = False
+        jump_pressed = False
+        events = pump_input(idle_wait)
+        frame_start = time.perf_counter()
+        with sim_lock:
+            for event_time, event in events:
+                if event.type == pygame.QUIT:
+                    quit_game()
+                if event.type == pygame.WINDOWEXPOSED:
+                    exposed = True
+                if event.type == pygame.VIDEORESIZE and not session:
+                    WIDTH, HEIGHT = event.w, event.h
+                    screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+                    game.generate_level()
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        if game.state == "playing":
+                            back_to_menu()
+                        elif game.state in ["game_over", "victory"]:
+                            back_to_menu()
+                    if event.key == pygame.K_SPACE and game.state == "playing":
+                        jump_pressed = True
+                        latency.mark("jump", event_time)
+                    if event.key in MOVE_KEYS and game.state == "playing":
+                        latency.mark("move", event_time)
+                    if event.key == pygame.K_F3:
+                        show_latency = not show_latency
+                    if event.key == pygame.K_r and game.state == "game_over":
+                        start_game()
+                    if event.key == pygame.K_RETURN and game.state == "victory":
+                        back_to_menu()
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    clicked = event.pos
+            # Peers must keep identical layouts, so a session pins the window
+            # to the relay's size and undoes any resize
+            if screen.get_size() != (WIDTH, HEIGHT):
+                screen = pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
+
+        if session and session.closed:
+            if session.refusal:
+                # Never got in: back to the menu with the reason instead of a level nobody drives
+                print(session.refusal)
+                net_notice = session.refusal
+                game.state = "main_menu"
+            session = None
+            game.from_pause = False
+
+        # Movement
+        keys = pygame.key.get_pressed()
+        bits = INPUT_JUMP if jump_pressed else 0
+        if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+            bits |= INPUT_LEFT
+        if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+            bits |= INPUT_RIGHT
+
+        rewinding = game.state == "playing" and keys[pygame.K_BACKSPACE] and not session
+        input_number = latency.next_input()
+        if sim:
+            sim.set_input(bits, rewinding, input_number)
+        else:
+            simulate(bits, rewinding)
+        # Play steps particles once a frame with the simulation; an idle screen
+        # catches them up by the ticks since it last woke
+        ticks = particle_clock.elapsed()
+        for _ in range(ticks if shown_ui else 1):
+            particles.update()
+
+        # --- Draw ---
+        # Threaded, draw the newest published frame rather than the live game
+        scene = sim.present() if sim else game
+        if scene.state == "main_menu":
+            ui = get_ui("main_menu", (scene.from_pause, net_notice), build_main_menu_ui)
+
+        elif scene.state == "instructions":
+            ui = get_ui("instructions", None, build_instructions_ui)
+
+        elif scene.state == "playing":
+            scene.draw_world()
+            if sim:
+                sim.draw_ghost()
+            elif ghost:
+                ghost.draw(scene.level)
+            scene.draw_players()
+            particles.draw(screen)
+            scene.draw_ui()
+            if rewinding:
+                rewind_text = font.render(f"<< REWIND  {rewind.seconds():.1f}s  "
+                                          f"{rewind.bytes_per_second() / 1024:.1f} KB/s", True, WHITE)
+                screen.blit(rewind_text, (WIDTH // 2 - rewind_text.get_width() // 2, 40))
+            if session:
+                net_text = font.render(f"P{scene.local_player + 1}  {session.bytes_per_second() / 1024:.2f} KB/s  "
+                                       f"rollbacks {session.rollbacks}", True, WHITE)
+                screen.blit(net_text, (WIDTH // 2 - net_text.get_width() // 2, 40))
+            if show_latency:
+                for i, kind in enumerate(latency.samples):
+                    st = latency.stats(kind)
+                    if st:
+                        latency_text = font.render(f"{kind}: p50 {st['p50']:.1f}  p95 {st['p95']:.1f}  "
+                                                   f"max {st['max']:.1f} ms", True, WHITE)
+                        screen.blit(latency_text, (10, 70 + i * 25))
+            ui = None
+            if clicked:
+                with sim_lock:
+                    get_ui("hud", None, build_hud_ui).click(clicked)
+
+        elif scene.state == "game_over":
+            # Keyed on the query itself too: a later run can end with the same coins and level
+            ui = get_ui("game_over", (scene.player.coins, scene.level, leaderboard,
+                                      leaderboard and leaderboard.done()), build_game_over_ui)
+
+        elif scene.state == "victory":
+            ui = get_ui("victory", (scene.player.coins, leaderboard, leaderboard and leaderboard.done()),
+                        build_victory_ui)
+
+        redraw = True
+        if ui:
+            ui.update(pygame.mouse.get_pos())
+            # Menu screens are only redrawn when they change or an animation is due
+            redraw = ui is not shown_ui or ui.dirty or exposed or ui.wait_time(pygame.time.get_ticks()) == 0
+            if redraw:
+                ui.draw(screen)
+            wait = ui.wait_time(pygame.time.get_ticks())
+            idle_wait = IDLE_MAX_WAIT if wait is None else min(wait, IDLE_MAX_WAIT)
+            if clicked:
+                with sim_lock:
+                    if ui.click(clicked):
+                        idle_wait = 0  # show the screen the click led to straight away
+            if scene.state != game.state:
+                idle_wait = 0  # threaded, the frame on screen is stale until the sim catches up
+        else:
+            idle_wait = 0
+        if (ui is None) != (shown_ui is None):
+            allow_idle_events(ui is not None)
+        shown_ui = ui
+
+        if redraw:
+            quality.draw_indicator(screen)
+            pygame.display.flip()
+            latency.presented(time.perf_counter(), sim.shown_input if sim else input_number)
+            # Idle wake-ups that draw nothing would read as spare headroom
+            quality.frame(time.perf_counter() - frame_start)
+        clock.tick(FPS)
+
+
+if __name__ == "__main__":
+    main()
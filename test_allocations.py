@@ -0,0 +1,14 @@
+import os
+
+# The game opens its window at import; keep it off-screen and silent
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+import Adventure_Dash as game  # noqa: E402
+
+
+def test_frame_allocations_stay_within_budget():
+    # Every measured tick is a full playing frame, bursts and HUD included
+    peaks = game.check_allocations()
+    assert peaks[-1] <= game.ALLOC_BUDGET_PER_TICK, (
+        f"a frame allocated {peaks[-1]} B, over the {game.ALLOC_BUDGET_PER_TICK} B budget")